@@ -21,7 +21,10 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, prune_perc
+from .pruning import select_trim_topk, select_top_k_appr, check_sparsity, prune_perc, \
+        clear_selected_, densify_selected
+from .momentum import dgc_momentum_
+from .codec import encode, decode_add_
 import horovod.torch as hvd
 
 import torch
@@ -50,6 +53,9 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._weight_decay = weight_decay
         self._debug = False #True 
         self._use_allgather = use_allgather 
+        self._fuse_momentum = False
+        # delta + variable length coding of the sent indices
+        self._delta_index = False
 
         # define U for residue, V for momentum
         if self._use_gpu:
@@ -57,18 +63,14 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()).cuda() for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_msg = {k: torch.zeros(0).cuda() for k, v
+            self._compressed_msg = {k: torch.zeros(0, dtype=torch.int32).cuda() for k, v
                                  in sorted(named_parameters)}
         else:
             self._V = {k: torch.zeros(v.size()) for k, v
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()) for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_msg = {k: torch.zeros(0) for k, v
+            self._compressed_msg = {k: torch.zeros(0, dtype=torch.int32) for k, v
                                  in sorted(named_parameters)}
         self._compressed_msg_size = {k: 0 for k, v
                                  in sorted(named_parameters)}
@@ -87,6 +89,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
         #if size() > 1:
         self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -102,77 +108,60 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
             if self._use_allgather and p_size > 1024:
                 # fjr compress grad
-                p.grad.data.div_(hvd.size())
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay, hvd.size(),
+                              self._use_nesterov, self._fuse_momentum)
                 compressed_val = []
                 compressed_idx = []
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_select_time =  time.time()
                 #self._masks[name], compressed_val, compressed_idx = select_top_k_appr(self._V[name], 0.001, self._masks[name])
-                self._masks[name], compressed_val, compressed_idx = select_top_k_thd(self._V[name], 0.001, self._masks[name])
-                torch.cuda.synchronize()
+                compressed_val, compressed_idx = select_trim_topk(self._V[name], 0.001)
+                self._device_sync()
                 end_select_time =  time.time()
                 self.select_time += end_select_time - begin_select_time
 
                 if self._debug:
-                    self._v_ref[name] = self._V[name] * self._masks[name]
+                    self._v_ref[name] = densify_selected(self._V[name], compressed_idx)
                     allreduce_(self._v_ref[name], average = False)
 
                 #self._V[name] = self._V[name] * (1 - self._masks[name])
                 #self._U[name] = self._U[name] * (1 - self._masks[name])
                 if hvd.size() == 1:
-                    p.grad.data = self._V[name] * (1.0 - self._masks[name])
+                    p.grad.data = densify_selected(self._V[name], compressed_idx)
 
-                self._V[name].mul_(self._masks[name])
-                self._U[name].mul_(self._masks[name])
+                clear_selected_(self._V[name], compressed_idx)
+                clear_selected_(self._U[name], compressed_idx)
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_comm_time =  time.time()
 
                 if hvd.size() > 1:
                     self._compressed_msg_size[name] = len(compressed_idx)
-                    if self._use_gpu:
-                        compressed_msg = torch.cat([compressed_idx.type('torch.cuda.FloatTensor'), \
-                                compressed_val])
-                    else:
-                        compressed_msg = torch.cat([compressed_idx.type('torch.FloatTensor'), \
-                                compressed_val])
+                    compressed_msg = encode(compressed_idx, compressed_val, p.numel(),
+                            delta=self._delta_index)
                     handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
                     self._handles[p] = handle
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_comm_time =  time.time()
                 self.pack_time += end_comm_time - begin_comm_time
 
             else:
-                p.grad.data.div_(hvd.size())
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    #self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                    p.grad.data = self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    #self._V[name] = self._V[name] + self._U[name]
-                    p.grad.data = self._U[name]
-                #p.grad.data = self._V[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], None,
+                              self._momentum, self._weight_decay, hvd.size(),
+                              self._use_nesterov, self._fuse_momentum)
                 #compressed_msg = torch.randn(100).cuda()
                 #handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
                 if hvd.size() > 1:
                     handle = allreduce_async_(p.grad.data, average=False, name=name)
                     self._handles[p] = handle
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -185,7 +174,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 synchronize(handle)
                 begin_time = time.time()
                 p_size = np.prod(p.size())
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_comm_time =  time.time()
                 if self._use_allgather and p_size > 1024:
                     #fjr decompress
@@ -198,26 +187,17 @@ class _DGCOptimizer(torch.optim.Optimizer):
                     #print("p_flatten size is ,", p_flatten.size())
                     #print("compressed msg, ", self._compressed_msg[name], 'rank, ', hvd.local_size())
                     #print("hand is ", handle)
-                    for node_idx in range(hvd.size()):
-                        if self._use_gpu:
-                            p_flatten[self._compressed_msg[name][node_idx*msg_size*2 : \
-                                    node_idx*msg_size*2 + msg_size].type('torch.cuda.LongTensor')] += \
-                                    self._compressed_msg[name][node_idx*msg_size*2 + msg_size : \
-                                    node_idx*msg_size*2 + 2*msg_size]
-                        else:
-                            p_flatten[self._compressed_msg[name][node_idx*msg_size*2 : \
-                                    node_idx*msg_size*2 + msg_size].type('torch.LongTensor')] += \
-                                    self._compressed_msg[name][node_idx*msg_size*2 + msg_size : \
-                                    node_idx*msg_size*2 + 2*msg_size]
+                    decode_add_(p_flatten, self._compressed_msg[name],
+                                None if self._delta_index else msg_size)
                     p.grad.data = p.grad.data.view(g_size)
                     if self._debug:
                         print("diff : ", torch.sum(self._v_ref[name] - p.grad.data))
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_comm_time =  time.time()
                 self.pack_time += end_comm_time - begin_comm_time
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_time = time.time()
                 self.pruning_time += end_time - begin_time
 
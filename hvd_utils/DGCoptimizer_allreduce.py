@@ -21,7 +21,9 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, prune_perc
+from .pruning import select_trim_topk, select_top_k_appr, check_sparsity, prune_perc, \
+        clear_selected_, densify_selected
+from .momentum import dgc_momentum_
 import horovod.torch as hvd
 
 import torch
@@ -48,6 +50,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._use_nesterov = True 
         self._momentum = momentum
         self._weight_decay = weight_decay
+        self._fuse_momentum = False
         self._debug = False
         self._use_allgather = use_allgather 
 
@@ -57,8 +60,6 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()).cuda() for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
             self._compressed_msg = {k: torch.zeros(0).cuda() for k, v
                                  in sorted(named_parameters)}
         else:
@@ -66,8 +67,6 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()) for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
             self._compressed_msg = {k: torch.zeros(0) for k, v
                                  in sorted(named_parameters)}
         self._compressed_msg_size = {k: 0 for k, v
@@ -87,6 +86,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
         #if size() > 1:
         self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -102,29 +105,24 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
             if self._use_allgather and p_size > 1024:
                 # fjr compress grad
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                p.grad.data.div_(hvd.size())
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay / hvd.size(), hvd.size(),
+                              self._use_nesterov, self._fuse_momentum)
                 compressed_val = []
                 compressed_idx = []
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_select_time =  time.time()
                 #self._masks[name], compressed_val, compressed_idx = select_top_k_appr(self._V[name], 0.001, self._masks[name])
-                self._masks[name], compressed_val, compressed_idx = select_top_k_thd(self._V[name], 0.001, self._masks[name])
-                torch.cuda.synchronize()
+                compressed_val, compressed_idx = select_trim_topk(self._V[name], 0.001)
+                self._device_sync()
                 end_select_time =  time.time()
                 self.select_time += end_select_time - begin_select_time
 
-                p.grad.data = self._V[name] * (1.0 - self._masks[name])
+                p.grad.data = densify_selected(self._V[name], compressed_idx)
                 handle = allreduce_async_(p.grad.data, average = False)
                 self._handles[p] = handle
 
@@ -133,10 +131,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #if hvd.size() == 1:
                 #    p.grad.data = self._V[name] * self._masks[name]
 
-                self._V[name].mul_(self._masks[name])
-                self._U[name].mul_(self._masks[name])
+                clear_selected_(self._V[name], compressed_idx)
+                clear_selected_(self._U[name], compressed_idx)
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_comm_time =  time.time()
 
                 #if hvd.size() > 1:
@@ -149,27 +147,19 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #    handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
                 #    self._handles[p] = handle
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_comm_time =  time.time()
                 self.pack_time += end_comm_time - begin_comm_time
 
             else:
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    #self._V[name] = self._U[name] + p.grad.data
-                    p.grad.data = self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    #self._V[name] = self._U[name]
-                    p.grad.data = self._U[name]
-                #compressed_msg = torch.randn(100).cuda()
-                #handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
+                dgc_momentum_(p.grad.data, p.data, self._U[name], None,
+                              self._momentum, self._weight_decay, 1,
+                              self._use_nesterov, self._fuse_momentum)
                 if hvd.size() > 1:
                     handle = allreduce_async_(p.grad.data, average=True, name=name)
                     self._handles[p] = handle
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -181,7 +171,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
             synchronize(handle)
             begin_time = time.time()
 
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_comm_time =  time.time()
             #if self._use_allgather and p_size > 1024 and hvd.size() > 1:
             #    #fjr decompress
@@ -210,11 +200,11 @@ class _DGCOptimizer(torch.optim.Optimizer):
             #    if self._debug:
             #        print("diff : ", torch.sum(self._v_ref[name] - p.grad.data))
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_comm_time =  time.time()
             self.pack_time += end_comm_time - begin_comm_time
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
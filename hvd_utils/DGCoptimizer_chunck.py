@@ -22,6 +22,7 @@ from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadc
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
 from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, prune_perc
+from .momentum import dgc_momentum_
 import horovod.torch as hvd
 
 import torch
@@ -48,6 +49,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._use_nesterov = True
         self._momentum = momentum
         self._weight_decay = weight_decay
+        self._fuse_momentum = False
         self._debug = False
         self._use_allgather = use_allgather 
 
@@ -57,8 +59,6 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()).cuda() for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
             self._compressed_msg = {k: torch.zeros(0).cuda() for k, v
                                  in sorted(named_parameters)}
         else:
@@ -66,8 +66,6 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()) for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
             self._compressed_msg = {k: torch.zeros(0) for k, v
                                  in sorted(named_parameters)}
         self._offset = {k: 0 for k, v
@@ -85,6 +83,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
         if size() > 1:
             self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -100,50 +102,42 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
             #if self._use_allgather and p_size > 1024 and len(p.size()) == 4:
             if self._use_allgather:
                 # fjr compress grad
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                p.grad.data.div_(hvd.size())
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
-                torch.cuda.synchronize()
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay / hvd.size(), hvd.size(),
+                              self._use_nesterov, self._fuse_momentum)
+                self._device_sync()
                 begin_select_time =  time.time()
 
-                compressed_idx = []
+                compressed_idx = slice(0, 0)
                 len_p = len(p)
                 chunk_size = len_p // 10;
                 if self._offset[name] + 2* chunk_size > len_p:
-                    compressed_idx = range(self._offset[name] , len_p)
+                    compressed_idx = slice(self._offset[name] , len_p)
                     self._offset[name] = 0
                 else:
-                    compressed_idx = range(self._offset[name] , self._offset[name] + chunk_size)
+                    compressed_idx = slice(self._offset[name] , self._offset[name] + chunk_size)
                     self._offset[name] += chunk_size
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_select_time =  time.time()
                 self.select_time += end_select_time - begin_select_time
 
-                self._masks[name].zero_()
-                self._masks[name][compressed_idx] = 1.0
-                self._masks[name] = 1.0 - self._masks[name]
-
                 if self._debug:
-                    self._v_ref[name] = self._V[name] * (1.0 - self._masks[name])
+                    self._v_ref[name] = torch.zeros_like(self._V[name])
+                    self._v_ref[name][compressed_idx] = self._V[name][compressed_idx]
                     allreduce_(self._v_ref[name], average = False)
 
                 #self._V[name] = self._V[name] * (1 - self._masks[name])
                 #self._U[name] = self._U[name] * (1 - self._masks[name])
-                self._V[name].mul_(self._masks[name])
-                self._U[name].mul_(self._masks[name])
+                self._V[name][compressed_idx].zero_()
+                self._U[name][compressed_idx].zero_()
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_pack_time =  time.time()
 
                 p.grad.zero_()
@@ -151,23 +145,19 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 handle = allreduce_async_(p.grad.data[compressed_idx], average=False, name=name)
                 self._handles[p] = handle
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 self.pack_time += time.time() - begin_pack_time
             else:
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
-                p.grad.data = self._V[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay, 1,
+                              self._use_nesterov, self._fuse_momentum)
+                p.grad.data.copy_(self._V[name])
                 #compressed_msg = torch.randn(100).cuda()
                 #handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
                 handle = allreduce_async_(p.grad.data, average=True, name=name)
                 self._handles[p] = handle
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -179,7 +169,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
             synchronize(handle)
             begin_time = time.time()
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -21,7 +21,10 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_thd_mean
+from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_thd_mean, \
+        clear_selected_, densify_selected
+from .codec import prefixed_segments
+from .momentum import dgc_momentum_
 import horovod.torch as hvd
 
 import torch
@@ -48,6 +51,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._use_nesterov = True
         self._momentum = momentum
         self._weight_decay = weight_decay
+        self._fuse_momentum = False
         self._debug = False #True 
         self._use_allgather = use_allgather ##True
         #self._use_allgather = False##True
@@ -60,9 +64,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()).cuda() for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_msg = {k: torch.zeros(0).cuda() for k, v
+            self._compressed_msg = {k: torch.zeros(0, dtype=torch.int32).cuda() for k, v
                                  in sorted(named_parameters)}
         else:
             self._V = {k: torch.zeros(v.size()) for k, v
@@ -71,9 +73,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()) for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_msg = {k: torch.zeros(0) for k, v
+            self._compressed_msg = {k: torch.zeros(0, dtype=torch.int32) for k, v
                                  in sorted(named_parameters)}
         self._compressed_len= {k: torch.zeros(0, dtype=torch.long) for k, v
                                  in sorted(named_parameters)}
@@ -83,6 +83,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                  in sorted(named_parameters)}
 
         self._handles = {}
+        self._handles_len = {}
         self._grad_accs = []
 
         #for timer
@@ -92,6 +93,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
         if size() > 1:
             self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -107,18 +112,13 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
             if self._use_allgather and p_size > 1024:
                 # fjr compress grad
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                p.grad.data.div_(hvd.size())
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay / hvd.size(), hvd.size(),
+                              self._use_nesterov, self._fuse_momentum)
                 compressed_val = []
                 compressed_idx = []
                 #if p_size < 1000:
@@ -127,10 +127,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
                     #self._masks[name], compressed_val, compressed_idx = select_top_k_thd(self._V[name], 0.001, self._masks[name])
                     #self._masks[name], compressed_val, compressed_idx = select_top_k_thd(self._V[name], 0.001, self._masks[name])
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_select_time =  time.time()
                 local_mean, compressed_idx = select_top_k_thd_mean(self._V[name], 0.001)
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_select_time = time.time()
                 self.select_time += end_select_time - begin_select_time 
 
@@ -141,54 +141,45 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 ##print("local_len, ", local_len)
                 #compressed_val = compressed_val[0:local_len]
                 #compressed_idx = compressed_idx[0:local_len]
-                masks_size = self._masks[name].size()
-                self._masks[name].zero_()
-                self._masks[name] = self._masks[name].view(-1)
-                self._masks[name][compressed_idx] = 1.0
-
-                self._masks[name] = 1.0 - self._masks[name]
-                self._masks[name] = self._masks[name].view(masks_size)
 
                 if self._debug:
-                    self._v_ref[name] = self._V[name] * (1.0 - self._masks[name])
+                    self._v_ref[name] = densify_selected(self._V[name], compressed_idx)
                     allreduce_(self._v_ref[name], average = False)
 
 
                 #self._V[name] = self._V[name] * (1 - self._masks[name])
                 #self._U[name] = self._U[name] * (1 - self._masks[name])
-                self._V[name].mul_(self._masks[name])
-                self._U[name].mul_(self._masks[name])
+                clear_selected_(self._V[name], compressed_idx)
+                clear_selected_(self._U[name], compressed_idx)
                 #self._compressed_msg_size[name] = len(compressed_idx)
-                if self._use_gpu:
-                    compressed_msg = torch.cat(\
-                            [torch.tensor([len(compressed_idx)]).type('torch.cuda.FloatTensor'), \
-                            torch.tensor([local_mean]).type('torch.cuda.FloatTensor'), \
-                            compressed_idx.type('torch.cuda.FloatTensor')])
-                else:
-                    pass
-
+                # int32 [n, mean bits, n indices], fp32 indices are only
+                # exact up to 2^24
+                compressed_msg = torch.cat(\
+                        [torch.tensor([len(compressed_idx)], dtype=torch.int32, device=compressed_idx.device), \
+                        torch.tensor([local_mean], dtype=torch.float, device=compressed_idx.device).view(torch.int32), \
+                        compressed_idx.to(torch.int32)])
+
+                # the lengths let the receiver lay out the messages in one go
+                self._handles_len[p] = allgather_async(torch.tensor([len(compressed_idx)],
+                        device=compressed_idx.device), name=name + ".len")
                 handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
                 #compressed_msg = torch.randn(100).cuda()
                 self._handles[p] = handle
 
             else:
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
-                p.grad.data = self._V[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay, 1,
+                              self._use_nesterov, self._fuse_momentum)
+                p.grad.data.copy_(self._V[name])
                 #compressed_msg = torch.randn(100).cuda()
                 #handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
                 handle = allreduce_async_(p.grad.data, average=True, name=name)
                 self._handles[p] = handle
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -198,7 +189,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
         for p in self._handles:
             handle = self._handles[p]
             synchronize(handle)
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
             p_size = np.prod(p.size())
             if self._use_allgather and p_size > 1024:
@@ -212,29 +203,21 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #print("p_flatten size is ,", p_flatten.size())
                 #print("compressed msg, ", self._compressed_msg[name], 'rank, ', hvd.local_size())
                 #print("hand is ", handle)
-                offset = 0
-                for node_idx in range(hvd.size()):
-                    if self._use_gpu:
-                        msg_size = self._compressed_msg[name][offset].type('torch.cuda.LongTensor')
-                        offset += 1
-                        local_mean = self._compressed_msg[name][offset]
-                        offset += 1
-                        p_flatten[self._compressed_msg[name][ offset: \
-                                offset + msg_size].type('torch.cuda.LongTensor')] += \
-                                local_mean
-                        offset += msg_size;
-                    else:
-                        pass
+                # [n, mean, n indices] per rank
+                msg = self._compressed_msg[name]
+                pos, rank, starts = prefixed_segments(msg, synchronize(self._handles_len[p]), head=2)
+                p_flatten.index_add_(0, msg[pos].long(), msg[starts - 1].view(torch.float32)[rank])
                 p.grad.data = p.grad.data.view(g_size)
                 if self._debug:
                     diff = torch.sum(self._v_ref[name] - p.grad.data)
                     if( torch.abs(diff) > 1e-6 ):
                         print("error diff is, ", diff, name, p.size())
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_time = time.time()
                 self.pruning_time += end_time - begin_time
 
         self._handles.clear()
+        self._handles_len.clear()
 
     def step(self, closure=None):
         self.synchronize()
@@ -3,7 +3,11 @@ from __future__ import division
 from __future__ import print_function
 
 import time
+import socket
+import functools
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from horovod.common import init
 from horovod.common import size
@@ -21,10 +25,21 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_trim_topk, select_topk, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_fixthd
+from .pruning import select_trim_topk, select_topk, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_fixthd, select_cached_thd, cached_thd_anchor, \
+        select_topk_batched, clear_selected_, densify_selected
+from .select_engine import SelectEngine
+from .momentum import dgc_momentum_
+from .codec import encode, decode_add_, message_size, quantize
+from .fusion import SparseFusion
+from .allgatherv import Allgatherv
+from .scheduler import CommScheduler
+from .sparse_allreduce import sparse_allreduce, sparse_reduce_scatter_allgather
 import horovod.torch as hvd
 
 import torch
+import torch.distributed as dist
+
+_AGGREGATIONS = ['allgather', 'sparse_allreduce', 'reduce_scatter']
 
 
 class _DGCOptimizer(torch.optim.Optimizer):
@@ -50,19 +65,16 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._weight_decay = weight_decay
         self._debug = False
         self._use_allgather = use_allgather ##True
+        self._fuse_momentum = False
+        # delta + variable length coding of the sent indices
+        self._delta_index = False
+        # None sends fp32 values, 'fp16', 'int8' or 'sign2' quantize them with
+        # stochastic rounding and put the rounding error back into the residual
+        self._value_format = None
+        self._stochastic_round = True
         #self._use_allgather = False##True
 
         # define U for residue, V for momentum
-        if self._use_gpu:
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_msg = {k: torch.zeros(0).cuda() for k, v
-                                 in sorted(named_parameters)}
-        else:
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_msg = {k: torch.zeros(0) for k, v
-                                 in sorted(named_parameters)}
         self._compressed_len= {k: torch.zeros(0, dtype=torch.long) for k, v
                                  in sorted(named_parameters)}
         self._mid_dict = {k: 0 for k, v
@@ -87,15 +99,223 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._mid = 0
         self._sparsity = 0.0
         self._it = 0
+        self._thd_tolerance = 0.5
+        self.thd_hit = 0
+        self.thd_miss = 0
         self._plan3 = 4194304
+        # 'radix' for exact top k, 'bin' for block-wise top k
+        self._huge_selector = 'radix'
         #self._plan3 = 4194304000
-        self._plan2 = 131072
         #self._plan1 = 102400
         self._plan1 = 8192
+        # layers up to _batch_numel are selected _batch_layers at a time
+        self._batch_numel = 131072
+        self._batch_layers = 16
+        self._pending_select = []
+        # layers above _plan3 are selected and sent _chunk_numel elements at
+        # a time, so that selecting a chunk overlaps sending the previous one
+        self._chunk_huge = True
+        self._chunk_numel = 1048576
+        self._chunk_handles = {}
+
+        # pick the fastest selector for every compressed layer size, rank 0
+        # tunes and broadcasts, so all ranks agree on the message format
+        self._select_engine = SelectEngine(0.001, use_gpu=self._use_gpu)
+        if self._use_allgather:
+            numels = [np.prod(v.size()) for k, v in sorted(named_parameters)
+                      if np.prod(v.size()) > self._batch_numel]
+            # huge layers get a selector whose time does not depend on the data
+            for numel in numels:
+                if numel > self._plan3:
+                    self._select_engine.pin(numel, self._huge_selector)
+                    if self._chunk_huge:
+                        for start, end in self._chunk_bounds(numel):
+                            self._select_engine.pin(end - start, self._huge_selector,
+                                                    chunk=True)
+            if hvd.rank() == 0:
+                self._select_engine.tune(numels)
+            if hvd.size() > 1:
+                plan = self._select_engine.export_plan(numels)
+                broadcast_(plan, root_rank=0, name='select_engine.plan')
+                self._select_engine.import_plan(numels, plan)
+        # threshold selectors send a data dependent count
+        self._msg_variable = {k: np.prod(v.size()) > self._batch_numel and
+                              not self._select_engine.is_exact(np.prod(v.size()))
+                              for k, v in sorted(named_parameters)}
+
+        # compression in the hooks, or handed over to worker threads, see
+        # set_async_compress
+        self._async_compress = False
+        self._compress_workers = 1
+        self._compress_futures = []
+        self._select_lock = threading.Lock()
+        self._timer_lock = threading.Lock()
+        self._executor = None
+        self._compress_stream = None
+
+        # collectives go out front layers first, as the next forward needs
+        # them, at most _credit_bytes at a time, dense ones in such pieces
+        self._schedule = True
+        self._credit_bytes = 4194304
+        self._scheduler = None
+        if self._schedule and hvd.size() > 1:
+            self._scheduler = CommScheduler(self._credit_bytes)
+        self._priority = {p: i for i, p in enumerate(
+                p for group in self.param_groups for p in group['params'])}
+
+        # compressed layers are gathered _fusion_words int32 words at a time,
+        # bucketed in the reverse registration order backward visits them in
+        self._fuse_sparse = True
+        self._fusion_words = 262144
+        self._fusion = None
+        if self._fuse_sparse and self._use_allgather and hvd.size() > 1:
+            compressed = [p for group in self.param_groups for p in group['params']
+                          if p.requires_grad and np.prod(p.size()) > self._plan1
+                          and not (self._chunk_huge and np.prod(p.size()) > self._plan3)]
+            compressed.reverse()
+            self._fusion = SparseFusion(compressed,
+                    [message_size(int(np.prod(p.size()) * 0.001) + 1) for p in compressed],
+                    self._fusion_words, scheduler=self._scheduler,
+                    priority=self._priority)
+        # unfused compressed layers go out in one collective each, their
+        # sizes are exchanged once per step
+        self._allgatherv = None
+        if self._fusion is None and self._use_allgather and hvd.size() > 1:
+            self._allgatherv = Allgatherv([p for group in self.param_groups
+                    for p in group['params']
+                    if p.requires_grad and np.prod(p.size()) > self._plan1],
+                    scheduler=self._scheduler, priority=self._priority)
+
+        # how every compressed layer is summed over the ranks, see set_aggregation
+        self._aggregation = {k: 'allgather' for k, v in sorted(named_parameters)}
+        self._dense_cutoff = 0.25
+        self._dist_group = None
+        # keep only the k largest aggregated entries, the rest goes back to
+        # the residuals
+        self._global_topk = False
+        self._pending_reduce = {}
+
+        # dense reduce inside a node, DGC among the node leaders only,
+        # then a broadcast inside the node, see set_hierarchical
+        self._hierarchical = False
+        self._node_group = None
+        self._node_leader = 0
+        self._node_size = 1
+        self._leader_group = None
+        self._is_leader = True
+        self._pending_node = {}
+
+        # decode and update every layer just before its next forward, see
+        # set_lazy_update
+        self._lazy = False
+        self._lazy_hooks = []
+        self._lazy_pending = set()
+        self._lazy_ready = set()
+        self._lazy_grads = {}
+        self._lazy_forward = False
 
         #if size() > 1:
         self._register_hooks()
 
+    def set_aggregation(self, name, algorithm):
+        r"""sum the compressed layer name with 'allgather' (horovod, the default),
+        'sparse_allreduce' (recursive doubling) or 'reduce_scatter' (index space
+        partitioned), the latter two run over torch.distributed in _dist_group"""
+        if algorithm not in _AGGREGATIONS:
+            raise ValueError('unknown aggregation %s, should be one of %s'
+                             % (algorithm, _AGGREGATIONS))
+        if algorithm != 'allgather' and not dist.is_initialized():
+            raise ValueError('aggregation %s needs torch.distributed, '
+                             'call init_process_group first' % algorithm)
+        self._aggregation[name] = algorithm
+
+    def set_async_compress(self, workers=1):
+        r"""let the hooks only hand compressed layers over to workers threads,
+        on gpu these run on their own stream and synchronize() waits for them.
+        the phase timers then no longer sync the device and only measure the
+        host time of the launches. call close() to stop the threads"""
+        if workers <= 0:
+            raise ValueError('workers should be positive, got %s' % workers)
+        if self._hierarchical and workers > 1:
+            raise ValueError('hierarchical compression needs a single worker, '
+                             'the leaders exchange in hook order')
+        self.close()
+        self._async_compress = True
+        self._compress_workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=self._compress_workers)
+        if self._use_gpu:
+            self._compress_stream = torch.cuda.Stream()
+
+    def close(self):
+        r"""finish the pending compression and stop the compress workers"""
+        if self._executor is None:
+            return
+        self._finish_compress()
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        self._compress_stream = None
+        self._async_compress = False
+
+    def __del__(self):
+        executor = getattr(self, '_executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def set_hierarchical(self):
+        r"""compress per node instead of per rank: the gradients of a node are
+        summed densely at its lowest rank, only these leaders keep residuals,
+        select and run the sparse exchange, the result is broadcast back inside
+        the node. builds the torch.distributed groups, so every rank has to call
+        it, after init_process_group.
+        the node reduce starts from the gradient hook and the leader selects
+        and exchanges on the compress worker, so both overlap backward when
+        async compression is on, the broadcasts run in synchronize(). the
+        sparse exchange runs over torch.distributed with set_aggregation's
+        algorithm, one blocking collective per layer on the worker: there is
+        no fusion, quantization, chunking, delta coding or threshold cache, so
+        it only pays off when the links between nodes are much slower than
+        the ones inside"""
+        if not dist.is_initialized():
+            raise ValueError('hierarchical compression needs torch.distributed, '
+                             'call init_process_group first')
+        if self._executor is not None and self._compress_workers > 1:
+            raise ValueError('hierarchical compression needs a single worker, '
+                             'the leaders exchange in hook order')
+        rank = dist.get_rank()
+        hosts = [None] * dist.get_world_size()
+        dist.all_gather_object(hosts, socket.gethostname())
+        nodes = sorted(set(hosts), key=hosts.index)
+        # new_group is collective, every rank creates every group in the same order
+        for host in nodes:
+            ranks = [r for r, h in enumerate(hosts) if h == host]
+            group = dist.new_group(ranks)
+            if host == hosts[rank]:
+                self._node_group = group
+                self._node_leader = ranks[0]
+                self._node_size = len(ranks)
+        leaders = [hosts.index(host) for host in nodes]
+        self._leader_group = dist.new_group(leaders)
+        self._is_leader = rank in leaders
+        self._hierarchical = True
+
+    def _chunk_bounds(self, numel):
+        # about _chunk_numel each, sizes differ by at most one
+        nchunks = -(-int(numel) // self._chunk_numel)
+        bounds = [int(numel) * i // nchunks for i in range(nchunks + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _device_sync(self):
+        # a device wide sync would make the hooks wait for the compress
+        # stream and the workers for backward, so with async compression the
+        # timers only measure host time
+        if self._use_gpu and self._executor is None:
+            torch.cuda.synchronize()
+
+    def _add_time(self, timer, seconds):
+        # the timers are updated from the hooks and the compress workers
+        with self._timer_lock:
+            setattr(self, timer, getattr(self, timer) + seconds)
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -107,241 +327,580 @@ class _DGCOptimizer(torch.optim.Optimizer):
 
     def _make_hook(self, p):
         def hook(*ignore):
+            if len(self._lazy_pending) > 0:
+                # no forward pre-hook applied these, e.g. parameters used
+                # outside their module, and zero_grad() did not run after the
+                # forward. apply them before this backward sends anything
+                self._lazy_apply(set(self._lazy_pending))
             assert p not in self._handles
             assert not p.grad.requires_grad
+            if self._scheduler is not None:
+                # pieces that finished since the last hook free their credit
+                self._scheduler.progress()
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
+            if self._lazy:
+                self._lazy_ready.add(p)
 
             if self._use_allgather and p_size > self._plan1:
-                torch.cuda.synchronize()
-                begin_mom_time =  time.time()
-
-                weight_decay = self._weight_decay #group['weight_decay']
-                momentum = self._momentum #group['momentum']
-                dampening = 0.0 #group['dampening']
-                d_p = p.grad.data
-                d_p.div_(hvd.size())
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                        buf.mul_(momentum).add_(d_p)
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-                    #TODO
-                if 'residue_buffer' not in param_state:
-                    rsd = param_state['residue_buffer'] = torch.zeros_like(p.data)
-                    rsd.add_(param_state['momentum_buffer'])
-                    if self._use_nesterov:
-                        rsd  = rsd.add(momentum, d_p)
+                if self._hierarchical:
+                    self._node_start(p)
+                elif self._executor is None:
+                    self._compress(p)
                 else:
-                    rsd = param_state['residue_buffer']
-                    rsd.add_(param_state['momentum_buffer'])
-                    if self._use_nesterov:
-                        rsd  = rsd.add(momentum, d_p)
-
-                torch.cuda.synchronize()
-                self.mom_time += time.time() - begin_mom_time
-
-                compressed_val = []
-                compressed_idx = []
-
-                torch.cuda.synchronize()
-                begin_select_time =  time.time()
-
-                if 'mid_store' not in param_state:
-                    param_state['mid_store'] = 0.0
-                if 'interval' not in param_state:
-                    param_state['interval'] = 10
-                it = 0
-                sparsity = 0.0
-
-                if p_size > self._plan3:
-                    compressed_val, compressed_idx, it, _, sparsity = \
-                        select_top_k_thdv3(param_state['residue_buffer'], 0.001)
-                elif p_size > self._plan2:
-                    compressed_val, compressed_idx = \
-                            select_trim_topk(param_state['residue_buffer'], 0.001)
-                else:
-                    compressed_val, compressed_idx = \
-                            select_topk(param_state['residue_buffer'], 0.001)
-
-                assert(len(compressed_idx) > 0)
-                torch.cuda.synchronize()
-                end_select_time =  time.time()
-                self.select_time += end_select_time - begin_select_time
-                #if param_state['interval'] == 10:
-                #    compressed_val, compressed_idx, it, param_state['mid_store'], sparsity = \
-                #            select_top_k_thdv3(param_state['residue_buffer'], 0.001)
-                #    param_state['interval'] = 0
-                #else:
-                #    compressed_val, compressed_idx, sparsity = \
-                #            select_top_k_fixthd(param_state['residue_buffer'], param_state['mid_store'])
-                #    param_state['interval'] += 1
-                #if hvd.rank() == 0:
-                #    print(name, p.size())
-                #if hvd.rank() == 0 and name == "features.27.weight":
-                #if name == "features.27.weight":
-                #    torch.save(compressed_val, 'compressed_val' + str(local_rank()))
-                #    torch.save(compressed_idx, 'compressed_idx' + str(local_rank()))
-                #if hvd.rank() == 0 and name == "features.27.weight":
-                #    self._it = it
-                #    self._mid = param_state['mid_store']
-                #    self._sparsity = sparsity
-                #tmp_t = torch.tensor([local_len], dtype=torch.long)
-#                tmp_t = torch.tensor([local_len])
-                # print("len list, ", global_len_list)
-                #local_len = torch.min(global_len_list)
-                ##print("local_len, ", local_len)
-                #compressed_val = compressed_val[0:local_len]
-                #compressed_idx = compressed_idx[0:local_len]
-
-                torch.cuda.synchronize()
-                begin_mask_time =  time.time()
-
-                masks_size = self._masks[name].size()
-                self._masks[name].zero_()
-                self._masks[name] = self._masks[name].view(-1)
-                self._masks[name][compressed_idx] = 1.0
-
-                self._masks[name] = 1.0 - self._masks[name]
-                self._masks[name] = self._masks[name].view(masks_size)
-
-                if self._debug:
-                    self._v_ref[name] = param_state['residue_buffer'] * (1.0 - self._masks[name])
-                    allreduce_(self._v_ref[name], average = False)
-
-
-                if hvd.size() == 1:
-                    p.grad.data = param_state['residue_buffer'] * (1.0 - self._masks[name])
-
-                param_state['residue_buffer'].mul_(self._masks[name])
-                param_state['momentum_buffer'].mul_(self._masks[name])
-
-                end_mask_time =  time.time()
-                self.mask_time += end_mask_time - begin_mask_time
-
-                torch.cuda.synchronize()
-                begin_pack_time =  time.time()
-
-                if hvd.size() > 1:
-                    if self._use_gpu:
-                        if p_size > self._plan3:
-                            compressed_msg = torch.cat([\
-                                    torch.tensor([len(compressed_idx)]).type('torch.cuda.FloatTensor'),\
-                                    compressed_idx.type('torch.cuda.FloatTensor'), \
-                                    compressed_val])
-                            handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
-                        else:
-                            self._compressed_msg_size[name] = len(compressed_idx)
-                            compressed_msg = torch.cat([compressed_idx.type('torch.cuda.FloatTensor'), \
-                                compressed_val])
-                            handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
-                    self._handles[p] = handle
-
-                torch.cuda.synchronize()
-                self.pack_time += time.time() - begin_pack_time
+                    ready = None
+                    if self._compress_stream is not None:
+                        ready = torch.cuda.Event()
+                        ready.record()
+                    self._compress_futures.append(
+                            self._executor.submit(self._compress_async, p, ready))
             else:
                 #compressed_msg = torch.randn(100).cuda()
                 #handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_allreduce_time =  time.time()
-                p.grad.data.div_(hvd.size())
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
                 param_state = self.state[p]
                 if 'momentum_buffer' not in param_state:
-                    buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                else:
-                    buf = param_state['momentum_buffer']
-                if self._use_nesterov:
-                    buf = torch.mul(torch.add(buf, p.grad.data), self._momentum)
-                    p.grad.data.add_(buf)
-                    #param_state['momentum_buffer'] = torch.mul(torch.add(param_state['momentum_buffer'], p.grad.data), self._momentum)
-                    #p.grad.data.add_(param_state['momentum_buffer'])
-                else:
-                    param_state['momentum_buffer'] = self._momentum * param_state['momentum_buffer'] + p.grad.data
-                    p.grad.data = param_state['momentum_buffer']
+                    param_state['momentum_buffer'] = torch.zeros_like(p.data)
+                dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'], None,
+                              self._momentum, self._weight_decay, hvd.size(),
+                              self._use_nesterov, self._fuse_momentum)
                 if hvd.size() > 1:
-                    handle = allreduce_async_(p.grad.data, average=False, name=name)
+                    if self._scheduler is None:
+                        handle = allreduce_async_(p.grad.data, average=False, name=name)
+                    else:
+                        handle = self._schedule_allreduce(p, name)
                     self._handles[p] = handle
-                torch.cuda.synchronize()
-                self.allreduce_time += time.time() - begin_allreduce_time
+                self._device_sync()
+                self._add_time('allreduce_time', time.time() - begin_allreduce_time)
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
-            self.pruning_time += end_time - begin_time
+            self._add_time('pruning_time', end_time - begin_time)
 
         return hook
 
-    def synchronize(self):
+    def _schedule_allreduce(self, p, name):
+        flat = p.grad.data.view(-1)
+        piece = max(1, self._credit_bytes // flat.element_size())
+        tasks = []
+        for i, chunk in enumerate(flat.split(piece)):
+            tasks.append(self._scheduler.submit(self._priority[p],
+                    chunk.numel() * chunk.element_size(),
+                    functools.partial(allreduce_async_, chunk, average=False,
+                                      name='%s.%d' % (name, i))))
+        return tasks
+
+    def _wait(self, handle):
+        if self._scheduler is None:
+            return synchronize(handle)
+        return self._scheduler.wait(handle)
+
+    def _compress_async(self, p, ready):
+        if self._compress_stream is None:
+            self._compress(p)
+            return
+        # the gradient is produced on the backward stream, wait for it
+        with torch.cuda.device(p.device):
+            self._compress_stream.wait_event(ready)
+            with torch.cuda.stream(self._compress_stream):
+                self._compress(p)
+
+    def _compress(self, p):
+        p_size = np.prod(p.size())
+        self._device_sync()
+        begin_mom_time =  time.time()
+
+        param_state = self.state[p]
+        if 'momentum_buffer' not in param_state:
+            param_state['momentum_buffer'] = torch.zeros_like(p.data)
+        if 'residue_buffer' not in param_state:
+            param_state['residue_buffer'] = torch.zeros_like(p.data)
+        # u = m * u + g, v += u; the nesterov term used to be added
+        # out of place and dropped, so it is not applied here either
+        dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'],
+                      param_state['residue_buffer'], self._momentum,
+                      self._weight_decay, hvd.size(), False, self._fuse_momentum)
+
+        self._device_sync()
+        self._add_time('mom_time', time.time() - begin_mom_time)
+
+        if (self._chunk_huge and p_size > self._plan3 and hvd.size() > 1
+                and self._aggregation[self._parameter_names.get(p)] == 'allgather'):
+            self._compress_chunked(p)
+            return
+
+        compressed_val = None
+        compressed_idx = None
+
+        self._device_sync()
+        begin_select_time =  time.time()
+
+        if p_size <= self._batch_numel:
+            # small layers are selected together, see _flush_select
+            with self._select_lock:
+                self._pending_select.append(p)
+                if len(self._pending_select) >= self._batch_layers:
+                    self._flush_select()
+        else:
+            # reuse the threshold of the last step while the count it
+            # yields stays within the tolerance band around top k. a hit
+            # sends top k, so block-wise selectors, whose count differs,
+            # do not use it or ranks would send different counts
+            use_thd = self._select_engine.is_global(p_size)
+            thd = None
+            if use_thd and 'thd_store' in param_state:
+                compressed_val, compressed_idx, sparsity, thd = select_cached_thd(
+                        param_state['residue_buffer'], 0.001,
+                        param_state['thd_store'], self._thd_tolerance)
+            hit = compressed_val is not None
+            if not hit:
+                compressed_val, compressed_idx = \
+                        self._select_engine.select(param_state['residue_buffer'])
+                if use_thd:
+                    # the middle of the band, the k-th magnitude is its edge
+                    thd = cached_thd_anchor(param_state['residue_buffer'], 0.001,
+                                            self._thd_tolerance)
+            if use_thd:
+                param_state['thd_store'] = thd
+                self._add_time('thd_hit' if hit else 'thd_miss', 1)
+
+            assert(len(compressed_idx) > 0)
+            self._device_sync()
+            end_select_time =  time.time()
+            self._add_time('select_time', end_select_time - begin_select_time)
+            self._sparse_send(p, compressed_val, compressed_idx)
+
+    def _compress_chunked(self, p):
+        name = self._parameter_names.get(p)
+        param_state = self.state[p]
+        residue = param_state['residue_buffer'].view(-1)
+        momentum = param_state['momentum_buffer'].view(-1)
+        chunks = []
+        for i, (start, end) in enumerate(self._chunk_bounds(p.numel())):
+            self._device_sync()
+            begin_select_time =  time.time()
+            # k in proportion to the chunk, selected on the chunk alone
+            compressed_val, compressed_idx = self._select_engine.select(residue[start:end],
+                                                                        chunk=True)
+            self._device_sync()
+            self._add_time('select_time', time.time() - begin_select_time)
+
+            clear_selected_(residue[start:end], compressed_idx)
+            clear_selected_(momentum[start:end], compressed_idx)
+            count = compressed_idx.numel()
+            compressed_val = self._quantize(p, compressed_idx + start, compressed_val)
+            compressed_msg = encode(compressed_idx, compressed_val, end - start,
+                    delta=self._delta_index)
+            output = compressed_msg.new_zeros(0)
+            # on its way while the next chunk is selected
+            start_allgather = functools.partial(_allgather_async, compressed_msg, output,
+                                                name='%s.chunk%d' % (name, i))
+            if self._scheduler is None:
+                handle = start_allgather()
+            else:
+                handle = self._scheduler.submit(self._priority[p],
+                        compressed_msg.numel() * 4, start_allgather)
+            chunks.append((start, end, count, handle, output))
+        self._compressed_msg_size[name] = sum(chunk[2] for chunk in chunks)
+        self._chunk_handles[p] = chunks
+
+    def _sparse_send(self, p, compressed_val, compressed_idx):
+        name = self._parameter_names.get(p)
+        param_state = self.state[p]
+        self._device_sync()
+        begin_mask_time =  time.time()
+
+        if self._debug:
+            self._v_ref[name] = densify_selected(param_state['residue_buffer'], compressed_idx)
+            allreduce_(self._v_ref[name], average = False)
+
+
+        if hvd.size() == 1:
+            p.grad.data = densify_selected(param_state['residue_buffer'], compressed_idx)
+
+        clear_selected_(param_state['residue_buffer'], compressed_idx)
+        clear_selected_(param_state['momentum_buffer'], compressed_idx)
+
+        end_mask_time =  time.time()
+        self._add_time('mask_time', end_mask_time - begin_mask_time)
+
+        self._device_sync()
+        begin_pack_time =  time.time()
+
         if hvd.size() > 1:
-            for p in self._handles:
-                handle = self._handles[p]
+            self._compressed_msg_size[name] = len(compressed_idx)
+            if self._aggregation[name] != 'allgather':
+                # reduced in synchronize(), where all ranks issue them in the same order
+                self._pending_reduce[p] = (compressed_idx, compressed_val)
+            elif self._fusion is not None:
+                self._fusion.add(p, encode(compressed_idx, self._quantize(p, compressed_idx,
+                        compressed_val), p.numel(), delta=self._delta_index))
+            else:
+                compressed_val = self._quantize(p, compressed_idx, compressed_val)
+                compressed_msg = encode(compressed_idx, compressed_val, p.numel(),
+                        delta=self._delta_index)
+                self._allgatherv.send(p, compressed_msg, name)
+
+        self._device_sync()
+        self._add_time('pack_time', time.time() - begin_pack_time)
+
+    def _quantize(self, p, compressed_idx, compressed_val):
+        if self._value_format is None:
+            return compressed_val
+        quantized = quantize(compressed_val, self._value_format, self._stochastic_round)
+        # the selected entries were just cleared, they keep what was not sent
+        self.state[p]['residue_buffer'].view(-1).index_add_(0, compressed_idx.long(),
+                (compressed_val - quantized.values).to(p.dtype))
+        return quantized
+
+    def _flush_select(self):
+        if len(self._pending_select) == 0:
+            return
+        self._device_sync()
+        begin_select_time =  time.time()
+        residues = [self.state[p]['residue_buffer'] for p in self._pending_select]
+        selected = select_topk_batched(residues, 0.001)
+        self._device_sync()
+        self._add_time('select_time', time.time() - begin_select_time)
+
+        for p, (compressed_val, compressed_idx) in zip(self._pending_select, selected):
+            self._sparse_send(p, compressed_val, compressed_idx)
+        self._pending_select = []
+
+    def _reduce(self, p, compressed_idx, compressed_val):
+        self._device_sync()
+        begin_time_sync = time.time()
+        name = self._parameter_names.get(p)
+        topk, shard_topk, residual = None, None, None
+        if self._global_topk:
+            topk = compressed_idx.numel()
+            shard_topk = -(-topk // dist.get_world_size(self._dist_group))
+            residual = self.state[p]['residue_buffer'].view(-1)
+        if self._aggregation[name] == 'sparse_allreduce':
+            idx, val = sparse_allreduce(compressed_idx, compressed_val, p.numel(),
+                                        self._dense_cutoff, self._dist_group, topk, residual)
+        else:
+            idx, val = sparse_reduce_scatter_allgather(compressed_idx, compressed_val,
+                                                       p.numel(), shard_topk,
+                                                       self._dist_group, residual)
+        g_size = p.grad.data.size()
+        p_flatten = p.grad.data.view(-1)
+        if idx is None:
+            p_flatten.copy_(val)
+        else:
+            p_flatten.zero_()
+            p_flatten[idx] = val
+        p.grad.data = p_flatten.view(g_size)
+        self._device_sync()
+        self._add_time('pruning_time', time.time() - begin_time_sync)
+
+    def _node_start(self, p):
+        # backward visits the layers in the same order on every rank, so the
+        # node reduces can go out from the hooks
+        work = dist.reduce(p.grad.data.view(-1), self._node_leader,
+                           group=self._node_group, async_op=True)
+        self._pending_node[p] = work
+        if self._is_leader and self._executor is not None:
+            # a single worker keeps the leader exchanges in hook order
+            self._compress_futures.append(
+                    self._executor.submit(self._node_compress_async, p, work))
+
+    def _node_compress_async(self, p, work):
+        if self._compress_stream is None:
+            self._node_compress(p, work)
+            return
+        with torch.cuda.device(p.device):
+            with torch.cuda.stream(self._compress_stream):
+                self._node_compress(p, work)
+
+    def _node_compress(self, p, work):
+        self._device_sync()
+        begin_time = time.time()
+        name = self._parameter_names.get(p)
+        p_flatten = p.grad.data.view(-1)
+        work.wait()
+        param_state = self.state[p]
+        if 'momentum_buffer' not in param_state:
+            param_state['momentum_buffer'] = torch.zeros_like(p.data)
+        if 'residue_buffer' not in param_state:
+            param_state['residue_buffer'] = torch.zeros_like(p.data)
+        # the node sum stands for _node_size ranks, each of which used to
+        # add its own weight decay term
+        dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'],
+                      param_state['residue_buffer'], self._momentum,
+                      self._weight_decay * self._node_size, dist.get_world_size(),
+                      False, self._fuse_momentum)
+        compressed_val, compressed_idx = \
+                self._select_engine.select(param_state['residue_buffer'])
+        clear_selected_(param_state['residue_buffer'], compressed_idx)
+        clear_selected_(param_state['momentum_buffer'], compressed_idx)
+
+        topk, shard_topk, residual = None, None, None
+        if self._global_topk:
+            topk = compressed_idx.numel()
+            shard_topk = -(-topk // dist.get_world_size(self._leader_group))
+            residual = param_state['residue_buffer'].view(-1)
+        if self._aggregation[name] == 'reduce_scatter':
+            idx, val = sparse_reduce_scatter_allgather(compressed_idx, compressed_val,
+                                                       p.numel(), shard_topk,
+                                                       self._leader_group, residual)
+        else:
+            idx, val = sparse_allreduce(compressed_idx, compressed_val, p.numel(),
+                                        self._dense_cutoff, self._leader_group,
+                                        topk, residual)
+        if idx is None:
+            p_flatten.copy_(val)
+        else:
+            p_flatten.zero_()
+            p_flatten[idx] = val
+        self._device_sync()
+        self._add_time('pruning_time', time.time() - begin_time)
+
+    def _node_finish(self, p, work):
+        if self._is_leader and self._executor is None:
+            self._node_compress(p, work)
+        else:
+            # done on the leaders, the sum must be out before it is overwritten
+            work.wait()
+        self._device_sync()
+        begin_time_sync = time.time()
+        dist.broadcast(p.grad.data.view(-1), self._node_leader, group=self._node_group)
+        self._device_sync()
+        self._add_time('pruning_time', time.time() - begin_time_sync)
+
+    def _truncate_(self, p, p_flatten, topk):
+        # every rank holds the same sum, so each one takes back
+        # 1/size of the entries that are dropped
+        _, keep = torch.topk(p_flatten.abs(), topk, sorted=False)
+        kept = p_flatten[keep]
+        p_flatten[keep] = 0
+        self.state[p]['residue_buffer'].view(-1).add_(p_flatten, alpha=1.0 / hvd.size())
+        p_flatten.zero_()
+        p_flatten[keep] = kept
+
+    def _unpack_chunks(self, p, chunks):
+        self._device_sync()
+        begin_time_sync = time.time()
+        name = self._parameter_names.get(p)
+        g_size = p.grad.data.size()
+        p_flatten = p.grad.data.view(-1)
+        p_flatten.zero_()
+        # decode every chunk as soon as it arrived, later ones are still on the way
+        for start, end, count, handle, output in chunks:
+            self._wait(handle)
+            if (self._delta_index or self._value_format
+                    or not self._select_engine.is_exact(end - start, chunk=True)):
+                count = None
+            decode_add_(p_flatten[start:end], output, count)
+        if self._global_topk:
+            self._truncate_(p, p_flatten, self._compressed_msg_size[name])
+        p.grad.data = p_flatten.view(g_size)
+        self._device_sync()
+        self._add_time('unpack_time', time.time() - begin_time_sync)
+        self._add_time('pruning_time', time.time() - begin_time_sync)
+
+    def _unpack(self, p, msg, starts=None):
+        self._device_sync()
+        begin_time_sync = time.time()
+        #fjr decompress
+        name = self._parameter_names.get(p)
+
+        g_size = p.grad.data.size()
+        p_flatten = p.grad.data.view(-1)
+        p_flatten.zero_()
+
+        self._device_sync()
+        begin_unpack_time =  time.time()
+        # exact selectors send the same count from every rank,
+        # only threshold, delta coded and quantized messages need
+        # their headers walked
+        count = None
+        if not (self._msg_variable[name] or self._delta_index or self._value_format):
+            count = self._compressed_msg_size[name]
+        decode_add_(p_flatten, msg, count, starts)
+        if self._global_topk:
+            self._truncate_(p, p_flatten, self._compressed_msg_size[name])
+
+        #if hvd.rank() == 0:
+        #    print("sparsity ", name, check_sparsity(p_flatten))
+
+        p.grad.data = p_flatten.view(g_size)
+        self._device_sync()
+        self._add_time('unpack_time', time.time() - begin_unpack_time)
+        self._device_sync()
+        self._add_time('pruning_time', time.time() - begin_time_sync)
+
+        if self._debug:
+            diff = torch.sum(self._v_ref[name] - p.grad.data)
+            if( torch.abs(diff) > 1e-3 ):
+                print("error diff is, ", diff, name, p.size())
+
+    def _finish_compress(self):
+        for future in self._compress_futures:
+            future.result()
+        self._compress_futures = []
+        if self._compress_stream is not None:
+            torch.cuda.current_stream().wait_stream(self._compress_stream)
+        self._flush_select()
+        if self._fusion is not None:
+            self._fusion.flush()
+        if self._scheduler is not None:
+            # start whatever is still queued before anything blocks, the
+            # credit limit only holds while backward is running
+            self._scheduler.flush()
+
+    def _outstanding(self):
+        # every rank has the same ones and takes them in the same order
+        params = set(self._handles) | set(self._chunk_handles) | \
+                set(self._pending_reduce) | set(self._pending_node)
+        if self._fusion is not None:
+            params.update(self._fusion.pending_keys())
+        if self._allgatherv is not None:
+            params.update(self._allgatherv.pending_keys())
+        return sorted(params, key=self._priority.get)
+
+    def _synchronize_param(self, p):
+        if p in self._handles:
+            handle = self._handles.pop(p)
+            if self._scheduler is None:
                 synchronize(handle)
-                #p_size = np.prod(p.size())
-
-                p_size = np.prod(p.size()) #torch.numel(p)
-                if self._use_allgather and p_size > self._plan1:
-
-                    torch.cuda.synchronize()
-                    begin_time_sync = time.time()
-                    #fjr decompress
-                    name = self._parameter_names.get(p)
-
-                    g_size = p.grad.data.size()
-                    p_flatten = p.grad.data.view(-1)
-                    p_flatten.zero_()
-
-                    torch.cuda.synchronize()
-                    begin_unpack_time =  time.time()
-                    if self._use_gpu:
-                        count_nnz = 0
-                        if p_size > self._plan3:
-                            offset = 0
-                            for node_idx in range(hvd.size()):
-                                msg_size = self._compressed_msg[name][offset].type('torch.cuda.LongTensor')
-                                offset += 1
-                                p_flatten[self._compressed_msg[name][ offset: \
-                                        offset + msg_size].type('torch.cuda.LongTensor')] += \
-                                        self._compressed_msg[name][offset + msg_size : \
-                                        offset + 2*msg_size]
-                                offset += msg_size * 2;
-                            count_nnz += msg_size
-                        else:
-                            msg_size = self._compressed_msg_size[name]
-                            for node_idx in range(hvd.size()):
-                                p_flatten[self._compressed_msg[name][node_idx*msg_size*2 : \
-                                    node_idx*msg_size*2 + msg_size].type('torch.cuda.LongTensor')] += \
-                                    self._compressed_msg[name][node_idx*msg_size*2 + msg_size : \
-                                    node_idx*msg_size*2 + 2*msg_size]
-
-                        #if hvd.rank() == 0:
-                        #    print("sparsity ", name, check_sparsity(p_flatten))
-
-                    p.grad.data = p_flatten.view(g_size)
-                    torch.cuda.synchronize()
-                    self.unpack_time += time.time() - begin_unpack_time
-                    torch.cuda.synchronize()
-                    self.pruning_time += time.time() - begin_time_sync
-
-                    if self._debug:
-                        diff = torch.sum(self._v_ref[name] - p.grad.data)
-                        if( torch.abs(diff) > 1e-3 ):
-                            print("error diff is, ", diff, name, p.size())
+            else:
+                for task in handle:
+                    self._wait(task)
+        elif p in self._chunk_handles:
+            self._unpack_chunks(p, self._chunk_handles.pop(p))
+        elif p in self._pending_reduce:
+            compressed_idx, compressed_val = self._pending_reduce.pop(p)
+            self._reduce(p, compressed_idx, compressed_val)
+        elif p in self._pending_node:
+            self._node_finish(p, self._pending_node.pop(p))
+        elif self._fusion is not None and p in self._fusion:
+            msg, starts = self._fusion.wait(p)
+            self._unpack(p, msg, starts)
+        else:
+            msg, starts = self._allgatherv.wait(p)
+            self._unpack(p, msg, starts)
+
+    def _poll_param(self, p):
+        if p in self._handles:
+            if self._scheduler is None:
+                return poll(self._handles[p])
+            return all(self._scheduler.poll(task) for task in self._handles[p])
+        if p in self._chunk_handles:
+            handles = [chunk[3] for chunk in self._chunk_handles[p]]
+            if self._scheduler is None:
+                return all(poll(handle) for handle in handles)
+            return all(self._scheduler.poll(handle) for handle in handles)
+        if self._fusion is not None and p in self._fusion:
+            return self._fusion.poll(p)
+        return self._allgatherv.poll(p)
 
-                else:
-                    pass
+    def synchronize(self):
+        self._finish_compress()
+        outstanding = self._outstanding()
+        # torch.distributed collectives block on the peers, they keep a fixed order
+        ordered = [p for p in outstanding if p in self._pending_reduce or p in self._pending_node]
+        waiting = [p for p in outstanding if p not in self._pending_reduce
+                   and p not in self._pending_node]
+        # decode whatever has landed, block only when nothing has
+        while len(waiting) > 0:
+            ready = [p for p in waiting if self._poll_param(p)]
+            if len(ready) == 0:
+                ready = waiting[:1]
+            for p in ready:
+                self._synchronize_param(p)
+                waiting.remove(p)
+        for p in ordered:
+            self._synchronize_param(p)
+
+    def set_lazy_update(self, model):
+        r"""defer the decode and update of every layer into a forward pre-hook
+        of its module, so that a layer of the next forward starts as soon as
+        its own message is in while later ones are still on the way. step()
+        then only finishes the compression, gradients of layers that still wait
+        for their update are set aside by zero_grad() until it is applied.
+        updates no pre-hook applied during a forward, of parameters used
+        outside their module, are applied by zero_grad() after the forward or
+        else by the first gradient hook of the next backward, so they come one
+        forward late but before the next gradient"""
+        for module in model.modules():
+            params = [p for p in module.parameters(recurse=False) if p in self._priority]
+            if len(params) > 0:
+                self._lazy_hooks.append(
+                        module.register_forward_pre_hook(self._make_lazy_hook(params)))
+        self._lazy_hooks.append(model.register_forward_hook(self._lazy_forward_hook))
+        self._lazy = True
+
+    def _lazy_forward_hook(self, *ignore):
+        self._lazy_forward = True
+
+    def _make_lazy_hook(self, params):
+        def hook(*ignore):
+            params_pending = [p for p in params if p in self._lazy_pending]
+            if len(params_pending) > 0:
+                self._lazy_apply(params_pending)
+        return hook
 
-        self._handles.clear()
+    def _lazy_apply(self, params):
+        # the messages zero_grad() set aside, a backward since then may have
+        # left a new gradient in their place
+        fresh = {}
+        for p in params:
+            if p in self._lazy_grads:
+                fresh[p] = p.grad
+                p.grad = self._lazy_grads.pop(p)
+        outstanding = set(self._outstanding())
+        for p in sorted(params, key=self._priority.get):
+            if p in outstanding:
+                self._synchronize_param(p)
+        # run the wrapped update on params alone
+        saved = [group['params'] for group in self.param_groups]
+        for group in self.param_groups:
+            group['params'] = [p for p in group['params'] if p in params]
+        try:
+            super(self.__class__, self).step()
+        finally:
+            for group, group_params in zip(self.param_groups, saved):
+                group['params'] = group_params
+        for p in params:
+            self._lazy_pending.discard(p)
+            if p in fresh:
+                p.grad = fresh[p]
 
     def step(self, closure=None):
-        self.synchronize()
-        return super(self.__class__, self).step(closure)
+        if not self._lazy:
+            self.synchronize()
+            return super(self.__class__, self).step(closure)
+        if closure is not None:
+            raise ValueError('closure is not supported with lazy updates')
+        # layers that no forward ran since the last step are applied now
+        if len(self._lazy_pending) > 0:
+            self._lazy_apply(set(self._lazy_pending))
+        self._finish_compress()
+        self._lazy_pending = self._lazy_ready
+        self._lazy_ready = set()
+        self._lazy_forward = False
+
+    def zero_grad(self, *args, **kwargs):
+        if self._lazy_forward and len(self._lazy_pending) > 0:
+            # a forward ran since step(), what it did not apply never will be
+            self._lazy_apply(set(self._lazy_pending))
+        if len(self._lazy_pending) == 0:
+            return super(self.__class__, self).zero_grad(*args, **kwargs)
+        # the gradient of a layer waiting for its update is its message, it
+        # is set aside so that the next backward starts from zero
+        for group in self.param_groups:
+            for p in group['params']:
+                if p in self._lazy_pending:
+                    if p.grad is not None and p not in self._lazy_grads:
+                        self._lazy_grads[p] = p.grad
+                        p.grad = None
+                elif p.grad is not None:
+                    p.grad.detach_()
+                    p.grad.zero_()
 
 
 def DGCDistributedOptimizer(optimizer, named_parameters=None, use_gpu=True, momentum=0.9, weight_decay=1e-4, use_allgather=True):
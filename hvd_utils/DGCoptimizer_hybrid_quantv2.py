@@ -21,7 +21,10 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_bs_top, select_bs_bottom, select_trim_topk_mean, select_trim_lowk_mean, select_topk_mean, select_lowk_mean
+from .pruning import select_bs_top, select_bs_bottom, select_trim_topk_mean, select_trim_lowk_mean, select_topk_mean, select_lowk_mean, \
+        clear_selected_, densify_selected
+from .codec import prefixed_segments
+from .momentum import dgc_momentum_
 import horovod.torch as hvd
 
 import torch
@@ -48,21 +51,22 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._use_nesterov = True
         self._momentum = momentum
         self._weight_decay = weight_decay
+        self._fuse_momentum = False
         self._debug = False
         self._use_allgather = use_allgather ##True
         #self._use_allgather = False##True
 
         # define U for residue, V for momentum
         if self._use_gpu:
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
             self._compressed_idx= {k: torch.zeros(0, dtype=torch.long).cuda() for k, v
                                  in sorted(named_parameters)}
-            self._compressed_val = {k: torch.zeros(0).cuda() for k, v
+            self._compressed_val = {k: torch.zeros(0, dtype=torch.int32).cuda() for k, v
                                  in sorted(named_parameters)}
         else:
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
+            self._compressed_idx= {k: torch.zeros(0, dtype=torch.long) for k, v
+                                 in sorted(named_parameters)}
+            self._compressed_val = {k: torch.zeros(0, dtype=torch.int32) for k, v
+                                 in sorted(named_parameters)}
         self._compressed_len= {k: torch.zeros(0, dtype=torch.long) for k, v
                                  in sorted(named_parameters)}
         self._mid_dict = {k: 0 for k, v
@@ -74,6 +78,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                  in sorted(named_parameters)}
 
         self._handles = {}
+        self._handles_len = {}
         self._handles_val = {}
         self._grad_accs = []
 
@@ -96,6 +101,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
         #if size() > 1:
         self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -111,47 +120,31 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
 
             if self._use_allgather and p_size > self._plan1:
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_mom_time =  time.time()
 
-                weight_decay = self._weight_decay #group['weight_decay']
-                momentum = self._momentum #group['momentum']
-                dampening = 0.0 #group['dampening']
-                d_p = p.grad.data
-                d_p.div_(hvd.size())
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                        buf.mul_(momentum).add_(d_p)
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-                    #TODO
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.zeros_like(p.data)
                 if 'residue_buffer' not in param_state:
-                    rsd = param_state['residue_buffer'] = torch.zeros_like(p.data)
-                    rsd.add_(param_state['momentum_buffer'])
-                    if self._use_nesterov:
-                        rsd  = rsd.add(momentum, d_p)
-                else:
-                    rsd = param_state['residue_buffer']
-                    rsd.add_(param_state['momentum_buffer'])
-                    if self._use_nesterov:
-                        rsd  = rsd.add(momentum, d_p)
-
-                torch.cuda.synchronize()
+                    param_state['residue_buffer'] = torch.zeros_like(p.data)
+                # u = m * u + g, v += u; the nesterov term used to be added
+                # out of place and dropped, so it is not applied here either
+                dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'],
+                              param_state['residue_buffer'], self._momentum,
+                              self._weight_decay, hvd.size(), False, self._fuse_momentum)
+
+                self._device_sync()
                 self.mom_time += time.time() - begin_mom_time
 
                 compressed_val = []
                 compressed_idx = []
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_select_time =  time.time()
 
                 if 'flag' not in param_state:
@@ -190,7 +183,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                         param_state['flag'] = 1
 
                 assert(len(compressed_idx) > 0)
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_select_time =  time.time()
                 self.select_time += end_select_time - begin_select_time
                 #if param_state['interval'] == 10:
@@ -219,77 +212,68 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #compressed_val = compressed_val[0:local_len]
                 #compressed_idx = compressed_idx[0:local_len]
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_mask_time =  time.time()
 
-                masks_size = self._masks[name].size()
-                self._masks[name].zero_()
-                self._masks[name] = self._masks[name].view(-1)
-                self._masks[name][compressed_idx] = 1.0
-
-                self._masks[name] = 1.0 - self._masks[name]
-                self._masks[name] = self._masks[name].view(masks_size)
-
                 if self._debug:
-                    self._v_ref[name] = param_state['residue_buffer'] * (1.0 - self._masks[name])
+                    self._v_ref[name] = densify_selected(param_state['residue_buffer'], compressed_idx)
                     allreduce_(self._v_ref[name], average = False)
 
 
                 if hvd.size() == 1:
-                    p.grad.data = param_state['residue_buffer'] * (1.0 - self._masks[name])
+                    p.grad.data = densify_selected(param_state['residue_buffer'], compressed_idx)
 
-                param_state['residue_buffer'].mul_(self._masks[name])
-                param_state['momentum_buffer'].mul_(self._masks[name])
+                clear_selected_(param_state['residue_buffer'], compressed_idx)
+                clear_selected_(param_state['momentum_buffer'], compressed_idx)
 
                 end_mask_time =  time.time()
                 self.mask_time += end_mask_time - begin_mask_time
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_pack_time =  time.time()
 
                 if hvd.size() > 1:
-                    if self._use_gpu:
-                        if p_size > self._plan3:
-                            compressed_msg= torch.cat((\
-                                torch.tensor([len(compressed_idx)]).type(torch.cuda.FloatTensor),\
-                                compressed_idx.type(torch.cuda.FloatTensor),\
-                                torch.mean(compressed_val).view(1)
-                                ))
-                            handle = _allgather_async(compressed_msg, self._compressed_val[name], \
-                                    name=name)
-                            self._handles[p] = handle
-                        else:
-                            self._compressed_msg_size[name] = len(compressed_idx)
-                            compressed_msg = torch.cat((\
-                                compressed_idx.type(torch.cuda.FloatTensor),\
-                                torch.mean(compressed_val).view(1)
-                                ))
-                            handle = _allgather_async(compressed_msg, self._compressed_val[name], \
-                                    name = name)
-                            self._handles[p] = handle
-                torch.cuda.synchronize()
+                    # int32 indices, only the mean goes as its fp32 bits
+                    mean_bits = torch.mean(compressed_val).float().view(1).view(torch.int32)
+                    if p_size > self._plan3:
+                        compressed_msg= torch.cat((\
+                            torch.tensor([len(compressed_idx)], dtype=torch.int32, device=compressed_idx.device),\
+                            compressed_idx.to(torch.int32),\
+                            mean_bits
+                            ))
+                        # the lengths let the receiver lay out the messages in one go
+                        self._handles_len[p] = allgather_async(torch.tensor([len(compressed_idx)],
+                                device=compressed_idx.device), name=name + ".len")
+                        handle = _allgather_async(compressed_msg, self._compressed_val[name], \
+                                name=name)
+                        self._handles[p] = handle
+                    else:
+                        self._compressed_msg_size[name] = len(compressed_idx)
+                        compressed_msg = torch.cat((\
+                            compressed_idx.to(torch.int32),\
+                            mean_bits
+                            ))
+                        handle = _allgather_async(compressed_msg, self._compressed_val[name], \
+                                name = name)
+                        self._handles[p] = handle
+                self._device_sync()
                 self.pack_time += time.time() - begin_pack_time
             else:
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_allreduce_time =  time.time()
-                p.grad.data.div_(hvd.size())
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
                 param_state = self.state[p]
                 if 'momentum_buffer' not in param_state:
                     param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                if self._use_nesterov:
-                    param_state['momentum_buffer'] = torch.mul(torch.add(param_state['momentum_buffer'], p.grad.data), self._momentum)
-                    p.grad.data = param_state['momentum_buffer'] + p.grad.data
-                else:
-                    param_state['momentum_buffer']= self._momentum * param_state['momentum_buffer'] + p.grad.data
-                    p.grad.data = param_state['momentum_buffer']
+                dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'], None,
+                              self._momentum, self._weight_decay, hvd.size(),
+                              self._use_nesterov, self._fuse_momentum)
                 if hvd.size() > 1:
                     handle = allreduce_async_(p.grad.data, average=False, name=name)
                     self._handles[p] = handle
-                torch.cuda.synchronize()
+                self._device_sync()
                 self.allreduce_time += time.time() - begin_allreduce_time
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -303,7 +287,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #p_size = np.prod(p.size())
                 p_size = torch.numel(p)
                 if self._use_allgather and p_size > self._plan1:
-                    torch.cuda.synchronize()
+                    self._device_sync()
                     begin_time_sync = time.time()
                     #fjr decompress
                     name = self._parameter_names.get(p)
@@ -312,35 +296,30 @@ class _DGCOptimizer(torch.optim.Optimizer):
                     p_flatten = p.grad.data.view(-1)
                     p_flatten.zero_()
 
-                    torch.cuda.synchronize()
+                    self._device_sync()
                     begin_unpack_time =  time.time()
-                    if self._use_gpu:
-                        if p_size > self._plan3:
-                            #count_nnz = 0
-                            offset = 0
-                            for node_idx in range(hvd.size()):
-                                msg_size = self._compressed_val[name][offset].type(torch.cuda.LongTensor)
-                                offset += 1
-                                p_flatten[self._compressed_val[name][ offset: \
-                                        offset + msg_size].type(torch.cuda.LongTensor)] += \
-                                        self._compressed_val[name][offset + msg_size]
-                                offset += msg_size + 1;
-                            #count_nnz += msg_size
-                            #if hvd.rank() == 0:
-                            #    print("sparsity ", name, count_nnz.cpu().numpy()/(p_size))
-                        else:
-                            msg_size = self._compressed_msg_size[name]
-                            offset = 0
-                            for node_idx in range(hvd.size()):
-                                p_flatten[self._compressed_val[name][offset : \
-                                        offset + msg_size].type(torch.cuda.LongTensor)] += \
-                                        self._compressed_val[name][offset + msg_size]
-                                offset += msg_size + 1;
+                    if p_size > self._plan3:
+                        #count_nnz = 0
+                        # [n, n indices, mean] per rank
+                        msg = self._compressed_val[name]
+                        lengths = synchronize(self._handles_len[p]).to(msg.device).long()
+                        pos, rank, starts = prefixed_segments(msg, lengths, tail=1)
+                        p_flatten.index_add_(0, msg[pos].long(),
+                                msg[starts + lengths].view(torch.float32)[rank])
+                        #count_nnz += msg_size
+                        #if hvd.rank() == 0:
+                        #    print("sparsity ", name, count_nnz.cpu().numpy()/(p_size))
+                    else:
+                        # [n indices, mean] per rank
+                        msg_size = self._compressed_msg_size[name]
+                        ranks = self._compressed_val[name].view(-1, msg_size + 1)
+                        p_flatten.index_add_(0, ranks[:, :msg_size].reshape(-1).long(),
+                                ranks[:, msg_size].contiguous().view(torch.float32).repeat_interleave(msg_size))
 
                     p.grad.data = p_flatten.view(g_size)
-                    torch.cuda.synchronize()
+                    self._device_sync()
                     self.unpack_time += time.time() - begin_unpack_time
-                    torch.cuda.synchronize()
+                    self._device_sync()
                     self.pruning_time += time.time() - begin_time_sync
 
                     if self._debug:
@@ -352,6 +331,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                     pass
 
         self._handles.clear()
+        self._handles_len.clear()
         self._handles_val.clear()
 
     def step(self, closure=None):
@@ -21,7 +21,8 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_top_k_thd, trunck_topk_param
+from .pruning import select_top_k_thd, trunck_topk_param, clear_selected_, densify_selected
+from .momentum import dgc_momentum_
 import horovod.torch as hvd
 
 import torch
@@ -48,6 +49,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._use_nesterov = True #False #True
         self._momentum = momentum
         self._weight_decay = weight_decay
+        self._fuse_momentum = False
         self._debug = False #True
         self._use_allgather = use_allgather
         self._prune_ratio = 0.001
@@ -58,7 +60,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()).cuda() for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
+        else:
+            self._V = {k: torch.zeros(v.size()) for k, v
+                                     in sorted(named_parameters)}
+            self._U = {k: torch.zeros(v.size()) for k, v
                                      in sorted(named_parameters)}
         self._compressed_msg_size = {k: 0 for k, v
                                  in sorted(named_parameters)}
@@ -79,6 +84,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
         #if size() > 1:
         self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -94,71 +103,61 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
             if self._use_allgather and p_size > 1024:
                 # fjr compress grad
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                p.grad.data.div_(hvd.size())
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay / hvd.size(), hvd.size(),
+                              self._use_nesterov, self._fuse_momentum)
                 compressed_val = []
                 compressed_idx = []
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_select_time =  time.time()
                 #self._masks[name], compressed_val, compressed_idx = select_top_k_appr(self._V[name], 0.001, self._masks[name])
-                self._masks[name], self._compressed_val[name], self._compressed_idx[name] = trunck_topk_param(\
+                self._compressed_val[name], self._compressed_idx[name] = trunck_topk_param(\
                         p.data, \
                         self._V[name], \
-                        self._prune_ratio, \
-                        self._masks[name])
-                torch.cuda.synchronize()
+                        self._prune_ratio)
+                self._device_sync()
                 end_select_time =  time.time()
                 self.select_time += end_select_time - begin_select_time
 
                 if self._debug:
-                    self._v_ref[name] = self._V[name] * self._masks[name]
+                    self._v_ref[name] = densify_selected(self._V[name], self._compressed_idx[name])
                     allreduce_(self._v_ref[name], average = False)
 
                 #self._V[name] = self._V[name] * (1 - self._masks[name])
                 #self._U[name] = self._U[name] * (1 - self._masks[name])
                 if hvd.size() == 1:
-                    p.grad.data = self._V[name] * (1.0 - self._masks[name])
+                    p.grad.data = densify_selected(self._V[name], self._compressed_idx[name])
 
-                self._V[name].mul_(self._masks[name])
-                self._U[name].mul_(self._masks[name])
+                clear_selected_(self._V[name], self._compressed_idx[name])
+                clear_selected_(self._U[name], self._compressed_idx[name])
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_comm_time =  time.time()
 
                 if hvd.size() > 1:
                     handle = allreduce_async_(self._compressed_val[name], average=False, name=name)
                     self._handles[p] = handle
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_comm_time =  time.time()
                 self.pack_time += end_comm_time - begin_comm_time
 
             else:
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
-                p.grad.data = self._V[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay, 1,
+                              self._use_nesterov, self._fuse_momentum)
+                p.grad.data.copy_(self._V[name])
                 #compressed_msg = torch.randn(100).cuda()
                 #handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
                 if hvd.size() > 1:
                     handle = allreduce_async_(p.grad.data, average=True, name=name)
                     self._handles[p] = handle
 
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -171,7 +170,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 synchronize(handle)
                 begin_time = time.time()
                 p_size = np.prod(p.size())
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_comm_time =  time.time()
                 if self._use_allgather and p_size > 1024:
                     #fjr decompress
@@ -185,11 +184,11 @@ class _DGCOptimizer(torch.optim.Optimizer):
                     if self._debug:
                         print("diff : ", torch.sum(self._v_ref[name] - p.grad.data))
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_comm_time =  time.time()
                 self.pack_time += end_comm_time - begin_comm_time
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_time = time.time()
                 self.pruning_time += end_time - begin_time
 
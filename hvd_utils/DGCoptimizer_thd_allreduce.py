@@ -21,7 +21,9 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_fixthd
+from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_fixthd, \
+        clear_selected_, densify_selected
+from .momentum import dgc_momentum_
 import horovod.torch as hvd
 
 import torch
@@ -48,19 +50,16 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._use_nesterov = True
         self._momentum = momentum
         self._weight_decay = weight_decay
+        self._fuse_momentum = False
         self._debug = False
         self._use_allgather = use_allgather ##True
         #self._use_allgather = False##True
 
         # define U for residue, V for momentum
         if self._use_gpu:
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
             self._compressed_msg = {k: torch.zeros(0).cuda() for k, v
                                  in sorted(named_parameters)}
         else:
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
             self._compressed_msg = {k: torch.zeros(0) for k, v
                                  in sorted(named_parameters)}
         self._compressed_len= {k: torch.zeros(0, dtype=torch.long) for k, v
@@ -84,6 +83,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
         if size() > 1:
             self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -99,40 +102,25 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
 
             if self._use_allgather and p_size > 1024:
-                weight_decay = self._weight_decay #group['weight_decay']
-                momentum = self._momentum #group['momentum']
-                dampening = 0.0 #group['dampening']
-                d_p = p.grad.data
-                d_p.div_(hvd.size())
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                        buf.mul_(momentum).add_(d_p)
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.zeros_like(p.data)
                 if 'residue_buffer' not in param_state:
-                    rsd = param_state['residue_buffer'] = torch.zeros_like(p.data)
-                    rsd.add_(param_state['momentum_buffer'])
-                    if self._use_nesterov:
-                        rsd  = rsd.add(momentum, d_p)
-                else:
-                    rsd = param_state['residue_buffer']
-                    rsd.add_(param_state['momentum_buffer'])
-                    if self._use_nesterov:
-                        rsd  = rsd.add(momentum, d_p)
+                    param_state['residue_buffer'] = torch.zeros_like(p.data)
+                # u = m * u + g, v += u; the nesterov term used to be added
+                # out of place and dropped, so it is not applied here either
+                dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'],
+                              param_state['residue_buffer'], self._momentum,
+                              self._weight_decay, hvd.size(), False, self._fuse_momentum)
 
                 compressed_val = []
                 compressed_idx = []
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_select_time =  time.time()
                 if 'mid_store' not in param_state:
                     param_state['mid_store'] = 0.0
@@ -161,7 +149,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #    self._it = it
                 #    self._mid = param_state['mid_store']
                 #    self._sparsity = sparsity
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_select_time =  time.time()
                 self.select_time += end_select_time - begin_select_time
                 #tmp_t = torch.tensor([local_len], dtype=torch.long)
@@ -172,53 +160,33 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #compressed_val = compressed_val[0:local_len]
                 #compressed_idx = compressed_idx[0:local_len]
 
-                masks_size = self._masks[name].size()
-                self._masks[name].zero_()
-                self._masks[name] = self._masks[name].view(-1)
-                self._masks[name][compressed_idx] = 1.0
 
-
-                self._masks[name] = 1.0 - self._masks[name]
-                self._masks[name] = self._masks[name].view(masks_size)
-
-                p.grad.data = param_state['residue_buffer'] * (1.0 - self._masks[name])
+                p.grad.data = densify_selected(param_state['residue_buffer'], compressed_idx)
                 handle = allreduce_async_(p.grad.data, average = False)
                 self._handles[p] = handle
 
 
-                param_state['residue_buffer'].mul_(self._masks[name])
-                param_state['momentum_buffer'].mul_(self._masks[name])
+                clear_selected_(param_state['residue_buffer'], compressed_idx)
+                clear_selected_(param_state['momentum_buffer'], compressed_idx)
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_pack_time =  time.time()
                 #compressed_msg = torch.randn(100).cuda()
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 self.pack_time += time.time() - begin_pack_time
             else:
-                weight_decay = self._weight_decay #group['weight_decay']
-                momentum = self._momentum #group['momentum']
-                dampening = 0.0 #group['dampening']
-                d_p = p.grad.data
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                        buf.mul_(momentum).add_(d_p)
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-                    if self._use_nesterov:
-                        d_p = d_p.add(momentum, buf)
-                    else:
-                        d_p = buf
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.zeros_like(p.data)
+                dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'], None,
+                              self._momentum, self._weight_decay, 1,
+                              self._use_nesterov, self._fuse_momentum)
 
                 if hvd.size() > 1:
                     handle = allreduce_async_(p.grad.data, average=True, name=name)
                     self._handles[p] = handle
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -21,7 +21,10 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_fixthd, select_bs_bottom, select_bs_top
+from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_fixthd, select_bs_bottom, select_bs_top, \
+        clear_selected_, densify_selected
+from .codec import prefixed_segments
+from .momentum import dgc_momentum_
 import horovod.torch as hvd
 
 import torch
@@ -48,22 +51,21 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._use_nesterov = True
         self._momentum = momentum
         self._weight_decay = weight_decay
+        self._fuse_momentum = False
         self._debug = False
         self._use_allgather = use_allgather ##True
         #self._use_allgather = False##True
 
         # define U for residue, V for momentum
         if self._use_gpu:
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
             self._compressed_idx= {k: torch.zeros(0, dtype=torch.long).cuda() for k, v
                                  in sorted(named_parameters)}
             self._compressed_val = {k: torch.zeros(0).cuda() for k, v
                                  in sorted(named_parameters)}
         else:
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_msg = {k: torch.zeros(0) for k, v
+            self._compressed_idx= {k: torch.zeros(0, dtype=torch.long) for k, v
+                                 in sorted(named_parameters)}
+            self._compressed_val = {k: torch.zeros(0) for k, v
                                  in sorted(named_parameters)}
         self._compressed_len= {k: torch.zeros(0, dtype=torch.long) for k, v
                                  in sorted(named_parameters)}
@@ -73,6 +75,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                  in sorted(named_parameters)}
 
         self._handles = {}
+        self._handles_len = {}
         self._handles_val = {}
         self._grad_accs = []
 
@@ -87,6 +90,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
         #if size() > 1:
         self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -102,48 +109,25 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
 
             if self._use_allgather and p_size > 1024:
-                weight_decay = self._weight_decay #group['weight_decay']
-                momentum = self._momentum #group['momentum']
-                dampening = 0.0 #group['dampening']
-                nesterov = False #group['nesterov']
-                d_p = p.grad.data
-                d_p.div_(hvd.size())
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                        buf.mul_(momentum).add_(d_p)
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(d_p)
-                        #buf.mul_(momentum).add_(1 - dampening, d_p)
-                    #TODO
-                    # if nesterov:
-                    #     d_p = d_p.add(momentum, buf)
-                    # else:
-                    #     d_p = buf
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.zeros_like(p.data)
                 if 'residue_buffer' not in param_state:
-                    rsd = param_state['residue_buffer'] = torch.zeros_like(p.data)
-                    rsd.add_(param_state['momentum_buffer'])
-
-                    if self._use_nesterov:
-                        rsd  = rsd.add(momentum, d_p)
-                else:
-                    rsd = param_state['residue_buffer']
-                    rsd.add_(param_state['momentum_buffer'])
-                    if self._use_nesterov:
-                        rsd  = rsd.add(momentum, d_p)
+                    param_state['residue_buffer'] = torch.zeros_like(p.data)
+                # u = m * u + g, v += u; the nesterov term used to be added
+                # out of place and dropped, so it is not applied here either
+                dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'],
+                              param_state['residue_buffer'], self._momentum,
+                              self._weight_decay, hvd.size(), False, self._fuse_momentum)
 
                 compressed_val = []
                 compressed_idx = []
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_select_time =  time.time()
                 if 'interval' not in param_state:
                     param_state['interval'] = 1
@@ -158,74 +142,52 @@ class _DGCOptimizer(torch.optim.Optimizer):
                             select_bs_bottom(param_state['residue_buffer'], 0.001)
                     param_state['interval'] = 1
                 assert(len(compressed_idx) > 0)
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_select_time =  time.time()
                 self.select_time += end_select_time - begin_select_time
 
-                masks_size = self._masks[name].size()
-                self._masks[name].zero_()
-                self._masks[name] = self._masks[name].view(-1)
-                self._masks[name][compressed_idx] = 1.0
-
-                self._masks[name] = 1.0 - self._masks[name]
-                self._masks[name] = self._masks[name].view(masks_size)
-
                 if self._debug:
-                    self._v_ref[name] = torch.mean(compressed_val) \
-                            * (1.0 - self._masks[name])
+                    self._v_ref[name] = densify_selected(param_state['residue_buffer'], compressed_idx, torch.mean(compressed_val))
                     allreduce_(self._v_ref[name], average = False)
 
                 if hvd.size() == 1:
-                    p.grad.data = torch.mean(compressed_val) \
-                            * (1.0 - self._masks[name])
+                    p.grad.data = densify_selected(param_state['residue_buffer'], compressed_idx, torch.mean(compressed_val))
 
-                param_state['residue_buffer'].mul_(self._masks[name])
-                param_state['momentum_buffer'].mul_(self._masks[name])
+                clear_selected_(param_state['residue_buffer'], compressed_idx)
+                clear_selected_(param_state['momentum_buffer'], compressed_idx)
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_pack_time =  time.time()
                 compressed_msg = []
 
                 if hvd.size() > 1:
-                    if self._use_gpu:
-                        compressed_msg= torch.cat((\
-                                torch.tensor([len(compressed_idx)]).type(torch.cuda.LongTensor),\
-                                compressed_idx))
+                    compressed_msg= torch.cat((\
+                            torch.tensor([len(compressed_idx)], device=compressed_idx.device),\
+                            compressed_idx))
 
+                    # the lengths let the receiver lay out the messages in one go
+                    self._handles_len[p] = allgather_async(torch.tensor([len(compressed_idx)],
+                            device=compressed_idx.device), name=name + ".len")
                     handle = _allgather_async(compressed_msg, self._compressed_idx[name], name=name + "idx")
                     self._handles[p] = handle
 
                     handle = _allgather_async(torch.mean(compressed_val), self._compressed_val[name], name=name + "val")
                     self._handles_val[p] = handle
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 self.pack_time += time.time() - begin_pack_time
 
             else:
-                weight_decay = self._weight_decay #group['weight_decay']
-                momentum = self._momentum #group['momentum']
-                dampening = 0.0 #group['dampening']
-                d_p = p.grad.data
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                        buf.mul_(momentum).add_(d_p)
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-                    if self._use_nesterov:
-                        d_p = d_p.add(momentum, buf)
-                    else:
-                        d_p = buf
-                #compressed_msg = torch.randn(100).cuda()
-                #handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.zeros_like(p.data)
+                dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'], None,
+                              self._momentum, self._weight_decay, 1,
+                              self._use_nesterov, self._fuse_momentum)
                 if hvd.size() > 1:
                     handle = allreduce_async_(p.grad.data, average=True, name=name)
                     self._handles[p] = handle
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -236,7 +198,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
             for p in self._handles:
                 handle = self._handles[p]
                 synchronize(handle)
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_time = time.time()
                 p_size = np.prod(p.size())
                 if self._use_allgather and p_size > 1024:
@@ -247,35 +209,31 @@ class _DGCOptimizer(torch.optim.Optimizer):
                     #msg_size = self._compressed_msg_size[name]
                     #print("rank, msg_size is ", hvd.local_rank(), msg_size)
 
-                    torch.cuda.synchronize()
+                    self._device_sync()
                     begin_pack_time =  time.time()
 
                     g_size = p.grad.data.size()
                     p_flatten = p.grad.data.view(-1)
                     p_flatten.zero_()
-                    offset = 0
-                    for node_idx in range(hvd.size()):
-                        if self._use_gpu:
-                            msg_size = self._compressed_idx[name][offset]
-                            offset += 1
-                            p_flatten[self._compressed_idx[name][ offset: \
-                                    offset + msg_size]] += \
-                                    self._compressed_val[name][node_idx]
-                            offset += msg_size;
+                    # [n, n indices] per rank, one mean per rank
+                    msg = self._compressed_idx[name]
+                    pos, rank, _ = prefixed_segments(msg, synchronize(self._handles_len[p]))
+                    p_flatten.index_add_(0, msg[pos], self._compressed_val[name][rank])
 
                     p.grad.data = p_flatten.view(g_size)
-                    torch.cuda.synchronize()
+                    self._device_sync()
                     self.pack_time += time.time() - begin_pack_time
                     if self._debug:
                         diff = torch.sum(self._v_ref[name] - p.grad.data)
                         if( torch.abs(diff) > 1e-3 ):
                             print("error diff is, ", diff, name, p.size())
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_time = time.time()
                 self.pruning_time += end_time - begin_time
 
         self._handles.clear()
+        self._handles_len.clear()
         self._handles_val.clear()
 
     def step(self, closure=None):
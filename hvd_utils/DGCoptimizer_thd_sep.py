@@ -21,7 +21,11 @@ from horovod.torch.mpi_ops import allgather, allgather_async, _allgather_async
 from horovod.torch.mpi_ops import broadcast, broadcast_async, broadcast_, broadcast_async_
 from horovod.torch.mpi_ops import poll, synchronize
 import numpy as np
-from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_fixthd
+from .pruning import select_top_k_thd, select_top_k_appr, check_sparsity, select_top_k_thdv2, select_top_k_thdv3, select_top_k_fixthd, select_bin_topk, \
+        clear_selected_, densify_selected
+from .codec import encode, decode_add_
+from .allgatherv import Allgatherv
+from .momentum import dgc_momentum_
 import horovod.torch as hvd
 
 import torch
@@ -48,6 +52,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._use_nesterov = True
         self._momentum = momentum
         self._weight_decay = weight_decay
+        self._fuse_momentum = False
         self._debug = False #True
         self._use_allgather = use_allgather ##True
         #self._use_allgather = False##True
@@ -60,12 +65,6 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()).cuda() for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()).cuda() for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_idx= {k: torch.zeros(0, dtype=torch.long).cuda() for k, v
-                                 in sorted(named_parameters)}
-            self._compressed_val = {k: torch.zeros(0).cuda() for k, v
-                                 in sorted(named_parameters)}
         else:
             self._V = {k: torch.zeros(v.size()) for k, v
                                      in sorted(named_parameters)}
@@ -73,22 +72,19 @@ class _DGCOptimizer(torch.optim.Optimizer):
                                      in sorted(named_parameters)}
             self._U = {k: torch.zeros(v.size()) for k, v
                                      in sorted(named_parameters)}
-            self._masks = {k: torch.zeros(v.size()) for k, v
-                                     in sorted(named_parameters)}
-            self._compressed_idx = {k: torch.zeros(0) for k, v
-                                 in sorted(named_parameters)}
-            self._compressed_val = {k: torch.zeros(0) for k, v
-                                 in sorted(named_parameters)}
-        self._compressed_len= {k: torch.zeros(0, dtype=torch.long) for k, v
-                                 in sorted(named_parameters)}
         self._mid_dict = {k: 0 for k, v
                                  in sorted(named_parameters)}
+        self._compressed_msg_size = {k: 0 for k, v
+                                 in sorted(named_parameters)}
         self._v_ref = {k: [] for k, v
                                  in sorted(named_parameters)}
 
         self._handles = {}
-        self._handles_val = {}
-        self._handles_len = {}
+        # indices and values of a layer go out as one self describing
+        # message, the per rank sizes are exchanged once per step
+        self._allgatherv = Allgatherv([p for group in self.param_groups
+                for p in group['params']
+                if p.requires_grad and np.prod(p.size()) > 1024])
         self._grad_accs = []
 
         self.pruning_time = 0.0
@@ -98,10 +94,17 @@ class _DGCOptimizer(torch.optim.Optimizer):
         self._mid = 0
         self._sparsity = 0.0
         self._it = 0
+        # block-wise top k instead of the threshold select
+        self._use_bin_select = False
+        self._bin_size = 1024
 
         if size() > 1:
             self._register_hooks()
 
+    def _device_sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
     def _register_hooks(self):
         for param_group in self.param_groups:
             for p in param_group['params']:
@@ -117,41 +120,25 @@ class _DGCOptimizer(torch.optim.Optimizer):
             assert not p.grad.requires_grad
             name = self._parameter_names.get(p)
             p_size = np.prod(p.size())
-            torch.cuda.synchronize()
+            self._device_sync()
             begin_time =  time.time()
 
             if self._use_allgather and p_size > 1024:
-                weight_decay = self._weight_decay #group['weight_decay']
-                momentum = self._momentum #group['momentum']
-                dampening = 0.0 #group['dampening']
-                nesterov = False #group['nesterov']
-                d_p = p.grad.data
-                if weight_decay != 0:
-                    d_p.add_(weight_decay, p.data)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.zeros_like(p.data)
-                        buf.mul_(momentum).add_(d_p)
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(1 - dampening, d_p)
-                    #TODO
-                    # if nesterov:
-                    #     d_p = d_p.add(momentum, buf)
-                    # else:
-                    #     d_p = buf
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.zeros_like(p.data)
                 if 'residue_buffer' not in param_state:
-                    rsd = param_state['residue_buffer'] = torch.zeros_like(p.data)
-                    rsd.add_(param_state['momentum_buffer'])
-                else:
-                    rsd = param_state['residue_buffer']
-                    rsd.add_(param_state['momentum_buffer'])
+                    param_state['residue_buffer'] = torch.zeros_like(p.data)
+                # u = m * u + g, v += u; the nesterov term used to be added
+                # out of place and dropped, so it is not applied here either
+                dgc_momentum_(p.grad.data, p.data, param_state['momentum_buffer'],
+                              param_state['residue_buffer'], self._momentum,
+                              self._weight_decay, 1, False, self._fuse_momentum)
 
                 compressed_val = []
                 compressed_idx = []
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_select_time =  time.time()
                 if 'mid_store' not in param_state:
                     param_state['mid_store'] = 0.0
@@ -159,7 +146,10 @@ class _DGCOptimizer(torch.optim.Optimizer):
                     param_state['interval'] = 10
                 it = 0
                 sparsity = 0.0
-                if param_state['interval'] == 10:
+                if self._use_bin_select:
+                    compressed_val, compressed_idx = \
+                            select_bin_topk(param_state['residue_buffer'], self._bin_size, 1)
+                elif param_state['interval'] == 10:
                     compressed_val, compressed_idx, it, param_state['mid_store'], sparsity = \
                             select_top_k_thdv3(param_state['residue_buffer'], 0.001)
                     param_state['interval'] = 0
@@ -178,7 +168,7 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #    self._it = it
                 #    self._mid = param_state['mid_store']
                 #    self._sparsity = sparsity
-                torch.cuda.synchronize()
+                self._device_sync()
                 end_select_time =  time.time()
                 self.select_time += end_select_time - begin_select_time
                 #tmp_t = torch.tensor([local_len], dtype=torch.long)
@@ -189,26 +179,19 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #compressed_val = compressed_val[0:local_len]
                 #compressed_idx = compressed_idx[0:local_len]
 
-                masks_size = self._masks[name].size()
-                self._masks[name].zero_()
-                self._masks[name] = self._masks[name].view(-1)
-                self._masks[name][compressed_idx] = 1.0
-
-                self._masks[name] = 1.0 - self._masks[name]
-                self._masks[name] = self._masks[name].view(masks_size)
 
                 if self._debug:
-                    self._v_ref[name] = param_state['residue_buffer'] * (1.0 - self._masks[name])
+                    self._v_ref[name] = densify_selected(param_state['residue_buffer'], compressed_idx)
                     allreduce_(self._v_ref[name], average = False)
 
 
                 #self._V[name] = self._V[name] * (1 - self._masks[name])
                 #self._U[name] = self._U[name] * (1 - self._masks[name])
-                param_state['residue_buffer'].mul_(self._masks[name])
-                param_state['momentum_buffer'].mul_(self._masks[name])
+                clear_selected_(param_state['residue_buffer'], compressed_idx)
+                clear_selected_(param_state['momentum_buffer'], compressed_idx)
                 #self._compressed_msg_size[name] = len(compressed_idx)
 
-                torch.cuda.synchronize()
+                self._device_sync()
                 begin_pack_time =  time.time()
 
                 #if self._use_gpu:
@@ -220,36 +203,21 @@ class _DGCOptimizer(torch.optim.Optimizer):
                 #            torch.tensor([len(compressed_idx)]).type('torch.cuda.LongTensor'), \
                 #            compressed_idx])
 
-                handle = _allgather_async(compressed_idx, self._compressed_idx[name], name=name + 'idx')
-                #compressed_msg = torch.randn(100).cuda()
-                self._handles[p] = handle
+                self._allgatherv.send(p, encode(compressed_idx, compressed_val), name)
 
-                handle = _allgather_async(compressed_val, self._compressed_val[name], name=name + 'val')
-                #compressed_msg = torch.randn(100).cuda()
-                self._handles_val[p] = handle
-
-                handle = _allgather_async(torch.tensor([len(compressed_idx)]), self._compressed_len[name], name=name + 'len')
-                #handle = _allgather_async(len(compressed_idx), self._compressed_len[name], name=name + 'len')
-                #compressed_msg = torch.randn(100).cuda()
-                self._handles_len[p] = handle
-
-                torch.cuda.synchronize()
+                self._device_sync()
                 self.pack_time += time.time() - begin_pack_time
 
             else:
-                p.grad.data.add_(torch.mul(p.data, self._weight_decay))
-                if self._use_nesterov:
-                    self._U[name] = torch.mul(torch.add(self._U[name], p.grad.data), self._momentum)
-                    self._V[name] = self._V[name] + self._U[name] + p.grad.data
-                else:
-                    self._U[name] = self._momentum * self._U[name] + p.grad.data
-                    self._V[name] = self._V[name] + self._U[name]
-                p.grad.data = self._V[name]
+                dgc_momentum_(p.grad.data, p.data, self._U[name], self._V[name],
+                              self._momentum, self._weight_decay, 1,
+                              self._use_nesterov, self._fuse_momentum)
+                p.grad.data.copy_(self._V[name])
                 #compressed_msg = torch.randn(100).cuda()
                 #handle = _allgather_async(compressed_msg, self._compressed_msg[name], name=name)
                 handle = allreduce_async_(p.grad.data, average=True, name=name)
                 self._handles[p] = handle
-            torch.cuda.synchronize()
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
@@ -257,54 +225,40 @@ class _DGCOptimizer(torch.optim.Optimizer):
 
     def synchronize(self):
         for p in self._handles:
-            handle = self._handles[p]
-            synchronize(handle)
-            torch.cuda.synchronize()
+            synchronize(self._handles[p])
+        for p, (msg, starts) in self._allgatherv.synchronize().items():
+            self._device_sync()
             begin_time = time.time()
-            p_size = np.prod(p.size())
-            if self._use_allgather and p_size > 1024:
-                handle = self._handles_val[p]
-                synchronize(handle)
-                handle = self._handles_len[p]
-                synchronize(handle)
-                #fjr decompress
-                name = self._parameter_names.get(p)
-                #msg_size = self._compressed_msg_size[name]
-                #print("rank, msg_size is ", hvd.local_rank(), msg_size)
-
-                torch.cuda.synchronize()
-                begin_pack_time =  time.time()
-
-                g_size = p.grad.data.size()
-                p_flatten = p.grad.data.view(-1)
-                p_flatten.zero_()
-                #print("p_flatten size is ,", p_flatten.size())
-                #print("compressed msg, ", self._compressed_msg[name], 'rank, ', hvd.local_size())
-                #print("hand is ", handle)
-                offset = 0
-                for node_idx in range(hvd.size()):
-                    if self._use_gpu:
-                        msg_size = self._compressed_len[name][node_idx].long()
-                        p_flatten[self._compressed_idx[name][offset: offset+msg_size]] += \
-                                self._compressed_val[name][offset: offset+msg_size]
-                        offset += msg_size
-
-                torch.cuda.synchronize()
-                self.pack_time += time.time() - begin_pack_time
-
-                p.grad.data = p.grad.data.view(g_size)
-                if self._debug:
-                    diff = torch.sum(self._v_ref[name] - p.grad.data)
-                    if( torch.abs(diff) > 1e-6 ):
-                        print("error diff is, ", diff, name, p.size())
-
-            torch.cuda.synchronize()
+            #fjr decompress
+            name = self._parameter_names.get(p)
+            #msg_size = self._compressed_msg_size[name]
+            #print("rank, msg_size is ", hvd.local_rank(), msg_size)
+
+            self._device_sync()
+            begin_pack_time =  time.time()
+
+            g_size = p.grad.data.size()
+            p_flatten = p.grad.data.view(-1)
+            p_flatten.zero_()
+            #print("p_flatten size is ,", p_flatten.size())
+            #print("compressed msg, ", self._compressed_msg[name], 'rank, ', hvd.local_size())
+            #print("hand is ", handle)
+            decode_add_(p_flatten, msg, starts=starts)
+
+            self._device_sync()
+            self.pack_time += time.time() - begin_pack_time
+
+            p.grad.data = p.grad.data.view(g_size)
+            if self._debug:
+                diff = torch.sum(self._v_ref[name] - p.grad.data)
+                if( torch.abs(diff) > 1e-6 ):
+                    print("error diff is, ", diff, name, p.size())
+
+            self._device_sync()
             end_time = time.time()
             self.pruning_time += end_time - begin_time
 
         self._handles.clear()
-        self._handles_val.clear()
-        self._handles_len.clear()
 
     def step(self, closure=None):
         self.synchronize()
@@ -3,3 +3,10 @@ from . import DGCoptimizer_chunck
 from . import DGCoptimizer_exp
 from . import DGCoptimizer_thd
 from . import pruning
+from . import select_engine
+from . import momentum
+from . import codec
+from . import fusion
+from . import sparse_allreduce
+from . import allgatherv
+from . import scheduler
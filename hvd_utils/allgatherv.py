@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+from horovod.torch.mpi_ops import allgather, _allgather_async, poll, synchronize
+
+
+class Allgatherv(object):
+    r"""variable length allgather for self describing sparse messages.
+    every message goes out as it is in one _allgather_async, without a length
+    prefix or padding. horovod does not hand back the per rank sizes, so the
+    word counts of all messages of a step are gathered together in one small
+    allgather in synchronize(), and the rank offsets of all messages are one
+    prefix sum over them. all ranks have to send the same keys.
+    with a CommScheduler the messages go out by priority[key]."""
+    def __init__(self, keys, prefix='allgatherv', scheduler=None, priority=None):
+        self._keys = list(keys)
+        self._slot = {key: i for i, key in enumerate(self._keys)}
+        self._prefix = prefix
+        self._scheduler = scheduler
+        self._priority = priority
+        self._counts = torch.zeros(len(self._keys), dtype=torch.int64)
+        self._starts = None
+        self._handles = {}
+
+    def __contains__(self, key):
+        return key in self._slot
+
+    def pending_keys(self):
+        return list(self._handles.keys())
+
+    def send(self, key, msg, name):
+        self._counts[self._slot[key]] = msg.numel()
+        output = msg.new_zeros(0)
+        if self._scheduler is None:
+            handle = _allgather_async(msg, output, name=name)
+        else:
+            priority = 0 if self._priority is None else self._priority[key]
+            handle = self._scheduler.submit(priority, msg.numel() * 4,
+                    lambda: _allgather_async(msg, output, name=name))
+        self._handles[key] = (handle, output)
+
+    def _exchange_counts(self):
+        if self._starts is not None:
+            return
+        if self._scheduler is not None:
+            # nothing may be held back while this rank blocks on the counts
+            self._scheduler.flush()
+        counts = allgather(self._counts.view(1, -1), name='%s.counts' % self._prefix)
+        self._starts = (counts.cumsum(0) - counts).t().tolist()
+
+    def poll(self, key):
+        r"""whether wait(key) would not block, before the counts of the step
+        are in it would"""
+        if self._starts is None:
+            return False
+        handle = self._handles[key][0]
+        if self._scheduler is None:
+            return poll(handle)
+        return self._scheduler.poll(handle)
+
+    def wait(self, key):
+        r"""wait for the message of key only, returns (gathered buffer, per
+        rank start offsets). the counts go out with the first wait of a step"""
+        self._exchange_counts()
+        starts = self._starts[self._slot[key]]
+        handle, output = self._handles.pop(key)
+        if self._scheduler is None:
+            synchronize(handle)
+        else:
+            self._scheduler.wait(handle)
+        if len(self._handles) == 0:
+            self._counts.zero_()
+            self._starts = None
+        return output, starts
+
+    def synchronize(self):
+        r"""wait for all messages, returns key -> (gathered buffer, per rank
+        start offsets)"""
+        keys = list(self._handles.keys())
+        if self._priority is not None:
+            keys.sort(key=self._priority.get)
+        return {key: self.wait(key) for key in keys}
@@ -0,0 +1,398 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import collections
+import torch
+
+# A message is a flat int32 tensor
+#     [count, value format id, encoding id | payload]
+# so that the allgather of several ranks is just the concatenation of their
+# messages. Values are stored as their raw bits, fp16 values are packed two
+# per word and padded to a whole word. 'int8' values are one fp32 scale word
+# and four int8 codes per word, 'sign2' values are one fp32 scale word and
+# sixteen 2 bit codes in {-1, 0, +1} per word, see quantize.
+HEADER_SIZE = 3
+
+# encoding ids, payloads are
+#   ENC_COO:    count int32 indices, count values
+#   ENC_BITMAP: one bit per element, count values in index order
+#   ENC_DENSE:  numel values (count == numel)
+#   ENC_DELTA:  chunk width b, chunk count, the gaps between the sorted
+#               indices as little endian b bit chunks with a continuation
+#               bit each, count values in index order
+ENC_COO = 0
+ENC_BITMAP = 1
+ENC_DENSE = 2
+ENC_DELTA = 3
+
+_DTYPES = [torch.float32, torch.float16, 'int8', 'sign2']
+_DTYPE_ID = {dtype: i for i, dtype in enumerate(_DTYPES)}
+
+# values rounded to a value format, codes and scale are what is sent and
+# values is what they decode to
+Quantized = collections.namedtuple('Quantized', ['dtype', 'codes', 'scale', 'values'])
+
+
+def _value_words(count, dtype):
+    if dtype == 'int8':
+        return 1 + (count + 3) // 4
+    if dtype == 'sign2':
+        return 1 + (count + 15) // 16
+    itemsize = 2 if dtype == torch.float16 else 4
+    return (count * itemsize + 3) // 4
+
+
+def _bitmap_words(numel):
+    return (numel + 31) // 32
+
+
+def message_size(count, dtype=torch.float32, encoding=ENC_COO, numel=None):
+    r"""number of int32 words of one rank's message"""
+    if encoding == ENC_COO:
+        return HEADER_SIZE + count + _value_words(count, dtype)
+    if numel is None:
+        raise ValueError('numel is needed for encoding %d' % encoding)
+    if encoding == ENC_BITMAP:
+        return HEADER_SIZE + _bitmap_words(numel) + _value_words(count, dtype)
+    if encoding == ENC_DENSE:
+        return HEADER_SIZE + _value_words(numel, dtype)
+    if encoding == ENC_DELTA:
+        raise ValueError('the size of a delta coded message depends on the indices')
+    raise ValueError('unknown encoding %d' % encoding)
+
+
+def choose_encoding(count, numel, dtype=torch.float32):
+    r"""the encoding with the fewest words for count nonzeros out of numel"""
+    sizes = [message_size(count, dtype, encoding, numel)
+             for encoding in (ENC_COO, ENC_BITMAP, ENC_DENSE)]
+    # ties go to the earlier, cheaper to decode, encoding
+    return sizes.index(min(sizes))
+
+
+def _value_bits(val):
+    val = val.contiguous()
+    if val.dtype == torch.float16 and val.numel() % 2 == 1:
+        val = torch.cat([val, val.new_zeros(1)])
+    return val.view(torch.int32)
+
+
+def _pack_values(codes, dtype, scale):
+    if dtype == 'int8':
+        pad = (4 - codes.numel() % 4) % 4
+        codes = torch.cat([codes, codes.new_zeros(pad)])
+        return [scale.float().view(1).view(torch.int32), codes.view(torch.int32)]
+    if dtype == 'sign2':
+        # -1 wraps to the field 3
+        return [scale.float().view(1).view(torch.int32), _pack_fields(codes.to(torch.int64) & 3, 2)]
+    return [_value_bits(codes)]
+
+
+def _unpack_values(words, count, dtype):
+    if dtype == 'int8':
+        scale = words[:1].view(torch.float32)
+        return words[1:].view(torch.int8)[:count].float() * scale
+    if dtype == 'sign2':
+        scale = words[:1].view(torch.float32)
+        fields = _unpack_fields(words[1:], 2, count)
+        fields[fields == 3] = -1
+        return fields.float() * scale
+    return words.view(dtype)[:count]
+
+
+def quantize(val, dtype, stochastic=True):
+    r"""round the values to the value format dtype: 'fp16', 'int8' with a per
+    message scale or 'sign2', scale * {-1, 0, +1}. stochastic rounding keeps
+    them unbiased. returns a Quantized for encode, val - values is the error
+    that is not sent"""
+    val = val.float().contiguous()
+    if dtype in ('fp16', torch.float16):
+        if stochastic:
+            # add random bits below the 10 mantissa bits fp16 keeps and cut them off
+            bits = val.clamp(-65504, 65504).view(torch.int32)
+            noise = torch.randint(0, 1 << 13, bits.size(), dtype=torch.int32, device=val.device)
+            codes = ((bits + noise) & -(1 << 13)).view(torch.float32).half()
+        else:
+            codes = val.half()
+        return Quantized(torch.float16, codes, None, codes.float())
+    if dtype not in ('int8', 'sign2'):
+        raise ValueError('unknown value format %s, should be fp16, int8 or sign2' % dtype)
+    scale = val.abs().max().view(1)
+    if dtype == 'int8':
+        scale = scale / 127
+    scale[scale == 0] = 1
+    x = val / scale
+    if stochastic:
+        codes = torch.floor(x + torch.rand_like(x))
+    else:
+        codes = torch.round(x)
+    codes = codes.clamp(-127 if dtype == 'int8' else -1, 127 if dtype == 'int8' else 1)
+    codes = codes.to(torch.int8)
+    return Quantized(dtype, codes, scale, codes.float() * scale)
+
+
+def _pack_fields(fields, width):
+    per_word = 32 // width
+    numel = fields.numel()
+    padded = torch.zeros((numel + per_word - 1) // per_word * per_word,
+                         dtype=torch.int64, device=fields.device)
+    padded[:numel] = fields
+    shifts = torch.arange(per_word, dtype=torch.int64, device=fields.device) * width
+    words = (padded.view(-1, per_word) << shifts).sum(1)
+    # wrap the unsigned 32 bit words into int32
+    words[words >= 2 ** 31] -= 2 ** 32
+    return words.to(torch.int32)
+
+
+def _unpack_fields(words, width, numel):
+    per_word = 32 // width
+    shifts = torch.arange(per_word, dtype=torch.int64, device=words.device) * width
+    fields = (words.to(torch.int64).unsqueeze(1) >> shifts) & ((1 << width) - 1)
+    return fields.view(-1)[:numel]
+
+
+def _pack_bits(mask):
+    return _pack_fields(mask, 1)
+
+
+def _unpack_bits(words, numel):
+    return _unpack_fields(words, 1, numel).bool()
+
+
+def _gap_width(count, span):
+    # chunks as wide as the expected gap, so that most gaps fit in one chunk
+    mean_gap = max(2.0, float(span) / max(count, 1))
+    return min(31, int(math.ceil(math.log(mean_gap, 2))))
+
+
+def _pack_gaps(gaps, width):
+    max_chunks = (31 + width - 1) // width
+    shifts = torch.arange(max_chunks, dtype=torch.int64, device=gaps.device) * width
+    parts = gaps.unsqueeze(1) >> shifts
+    nchunks = (parts > 0).sum(1).clamp(min=1)
+    used = torch.arange(max_chunks, device=gaps.device).unsqueeze(0) < nchunks.unsqueeze(1)
+    more = torch.arange(max_chunks, device=gaps.device).unsqueeze(0) < (nchunks - 1).unsqueeze(1)
+    chunks = (parts & ((1 << width) - 1)) | (more.to(torch.int64) << width)
+    chunks = chunks[used]
+    bit_shifts = torch.arange(width + 1, dtype=torch.int64, device=gaps.device)
+    bits = (chunks.unsqueeze(1) >> bit_shifts) & 1
+    return chunks.numel(), _pack_bits(bits.view(-1))
+
+
+def _unpack_gaps(words, width, nchunks, count):
+    bits = _unpack_bits(words, nchunks * (width + 1)).view(nchunks, width + 1).to(torch.int64)
+    bit_shifts = torch.arange(width, dtype=torch.int64, device=words.device)
+    chunks = (bits[:, :width] << bit_shifts).sum(1)
+    last = bits[:, width] == 0
+    # chunk i belongs to the gap numbered by the gap ends before it
+    gap_id = last.to(torch.int64).cumsum(0) - last.to(torch.int64)
+    first = torch.zeros(count, dtype=torch.int64, device=words.device)
+    first[1:] = last.nonzero().view(-1)[:-1] + 1
+    pos = torch.arange(nchunks, dtype=torch.int64, device=words.device) - first[gap_id]
+    gaps = torch.zeros(count, dtype=torch.int64, device=words.device)
+    gaps.index_add_(0, gap_id, chunks << (pos * width))
+    return gaps
+
+
+def encode(idx, val, numel=None, encoding=None, delta=False):
+    r"""pack the indices as int32 and the values bit for bit into one int32 tensor,
+    indices go up to 2^31 - 1 instead of the 2^24 exactly representable in fp32.
+    with numel the cheapest of index list, bitmap and dense is picked unless
+    encoding is given, the choice is tagged in the header. delta=True sends
+    index lists as delta + variable length coded sorted indices.
+    val is a fp32 or fp16 tensor, or the Quantized returned by quantize"""
+    if isinstance(val, Quantized):
+        dtype, scale, val = val.dtype, val.scale, val.codes
+    elif val.dtype in (torch.float32, torch.float16):
+        dtype, scale = val.dtype, None
+    else:
+        raise ValueError('values should be fp32, fp16 or quantized, got %s' % val.dtype)
+    count = idx.numel()
+    if encoding is None:
+        encoding = ENC_COO if numel is None else choose_encoding(count, numel, dtype)
+        if delta and encoding == ENC_COO:
+            encoding = ENC_DELTA
+    if encoding in (ENC_BITMAP, ENC_DENSE) and numel is None:
+        raise ValueError('numel is needed for encoding %d' % encoding)
+
+    if encoding == ENC_COO:
+        payload = [idx.to(torch.int32)] + _pack_values(val, dtype, scale)
+    elif encoding == ENC_BITMAP:
+        dense = torch.zeros(numel, dtype=val.dtype, device=val.device)
+        dense[idx] = val
+        mask = torch.zeros(numel, dtype=torch.bool, device=val.device)
+        mask[idx] = True
+        payload = [_pack_bits(mask)] + _pack_values(dense[mask], dtype, scale)
+    elif encoding == ENC_DENSE:
+        dense = torch.zeros(numel, dtype=val.dtype, device=val.device)
+        dense[idx] = val
+        count = numel
+        payload = _pack_values(dense, dtype, scale)
+    elif encoding == ENC_DELTA:
+        sorted_idx, order = idx.to(torch.int64).sort()
+        gaps = sorted_idx.clone()
+        gaps[1:] -= sorted_idx[:-1]
+        span = numel if numel is not None else int(sorted_idx[-1]) + 1 if count else 1
+        width = _gap_width(count, span)
+        nchunks, words = _pack_gaps(gaps, width)
+        param = torch.tensor([width, nchunks], dtype=torch.int32, device=idx.device)
+        payload = [param, words] + _pack_values(val[order], dtype, scale)
+    else:
+        raise ValueError('unknown encoding %d' % encoding)
+    header = torch.tensor([count, _DTYPE_ID[dtype], encoding],
+                          dtype=torch.int32, device=idx.device)
+    return torch.cat([header] + payload)
+
+
+def _decode_one(msg, offset, count, dtype, encoding, numel, delta_param=None):
+    if encoding == ENC_COO:
+        idx = msg[offset: offset + count]
+        offset += count
+    elif encoding == ENC_BITMAP:
+        words = _bitmap_words(numel)
+        idx = _unpack_bits(msg[offset: offset + words], numel).nonzero().view(-1)
+        offset += words
+    elif encoding == ENC_DENSE:
+        idx = None
+    elif encoding == ENC_DELTA:
+        if delta_param is None:
+            delta_param = msg[offset: offset + 2].tolist()
+        width, nchunks = delta_param
+        offset += 2
+        words = _bitmap_words(nchunks * (width + 1))
+        idx = _unpack_gaps(msg[offset: offset + words], width, nchunks, count).cumsum(0)
+        offset += words
+    else:
+        raise ValueError('unknown encoding %d' % encoding)
+    words = _value_words(count, dtype)
+    val = _unpack_values(msg[offset: offset + words], count, dtype)
+    return idx, val, offset + words
+
+
+def _read_headers(msg, starts):
+    # the headers of all ranks in one host transfer, with the two words after
+    # them that hold the chunk width and count of delta coded messages
+    positions = torch.tensor(starts, dtype=torch.int64, device=msg.device)
+    positions = positions.unsqueeze(1) + torch.arange(HEADER_SIZE + 2, device=msg.device)
+    words = msg[positions.clamp(max=msg.numel() - 1)].tolist()
+    return [word[:HEADER_SIZE] + [word[HEADER_SIZE:]] for word in words]
+
+
+def _decode_at(msg, starts, headers, numel):
+    ret = []
+    for offset, (n, dtype_id, encoding, delta_param) in zip(starts, headers):
+        if encoding == ENC_BITMAP and numel is None:
+            raise ValueError('numel is needed to decode a bitmap message')
+        idx, val, _ = _decode_one(msg, offset + HEADER_SIZE, n,
+                                  _DTYPES[dtype_id], encoding, numel, delta_param)
+        ret.append((idx, val))
+    return ret
+
+
+def decode(msg, count=None, numel=None, starts=None):
+    r"""split an allgathered buffer into per rank (indices, values), index lists
+    and unquantized values are views of msg, quantized values come back as
+    fp32, dense messages come back with indices None.
+    count is the per rank nnz when every rank is known to send the same number
+    of fp32 values without delta coding, then no header is read on the host.
+    numel, the size of the gradient, is needed for bitmap messages.
+    with the per rank start offsets, as from Allgatherv, all headers are read
+    in one go instead of one rank after the other"""
+    if starts is not None:
+        return _decode_at(msg, starts, _read_headers(msg, starts), numel)
+    ret = []
+    offset = 0
+    total = msg.numel()
+    while offset < total:
+        if count is None:
+            n, dtype_id, encoding = msg[offset: offset + HEADER_SIZE].tolist()
+        else:
+            # every rank made the same choice from the same count
+            n, dtype_id = count, _DTYPE_ID[torch.float32]
+            encoding = ENC_COO if numel is None else choose_encoding(count, numel)
+            if encoding == ENC_DENSE:
+                n = numel
+        if encoding == ENC_BITMAP and numel is None:
+            raise ValueError('numel is needed to decode a bitmap message')
+        idx, val, offset = _decode_one(msg, offset + HEADER_SIZE, n,
+                                       _DTYPES[dtype_id], encoding, numel)
+        ret.append((idx, val))
+    return ret
+
+
+def _add_coo_(dst, msg, starts, counts, dtype):
+    # index lists of all ranks gathered by position, msg has to be the whole
+    # contiguous buffer the starts refer to
+    device = msg.device
+    total = sum(counts)
+    counts = torch.tensor(counts, dtype=torch.int64, device=device)
+    first_idx = torch.tensor(starts, dtype=torch.int64, device=device) + HEADER_SIZE
+    rank = torch.repeat_interleave(torch.arange(counts.numel(), device=device), counts,
+                                   output_size=total)
+    j = torch.arange(total, device=device) - (counts.cumsum(0) - counts)[rank]
+    idx = msg[first_idx[rank] + j]
+    first_val = first_idx + counts
+    if dtype == torch.float16:
+        val = msg.view(torch.float16)[2 * first_val[rank] + j]
+    else:
+        val = msg.view(torch.float32)[first_val[rank] + j]
+    dst.index_add_(0, idx.to(torch.int64), val.to(dst.dtype))
+    return dst
+
+
+def decode_add_(dst, msg, count=None, starts=None):
+    r"""accumulate every rank's message into the flat tensor dst with a single
+    index_add_, fixed size index lists are read as a [world, words] view.
+    with the per rank start offsets msg may hold other messages as well, index
+    lists of one value type are then gathered by position"""
+    numel = dst.numel()
+    if count is not None and choose_encoding(count, numel) == ENC_COO:
+        if starts is not None:
+            return _add_coo_(dst, msg, starts, [count] * len(starts), torch.float32)
+        ranks = msg.view(-1, message_size(count))
+        idx = ranks[:, HEADER_SIZE: HEADER_SIZE + count].reshape(-1)
+        val = ranks[:, HEADER_SIZE + count:].reshape(-1).view(torch.float32)
+        dst.index_add_(0, idx, val.to(dst.dtype))
+        return dst
+    if starts is not None:
+        headers = _read_headers(msg, starts)
+        dtypes = set(dtype_id for _, dtype_id, _, _ in headers)
+        if (all(encoding == ENC_COO for _, _, encoding, _ in headers) and len(dtypes) == 1
+                and _DTYPES[dtypes.pop()] in (torch.float32, torch.float16)):
+            return _add_coo_(dst, msg, starts, [n for n, _, _, _ in headers],
+                             _DTYPES[headers[0][1]])
+        pieces = _decode_at(msg, starts, headers, numel)
+    else:
+        pieces = decode(msg, count, numel)
+    sparse_idx, sparse_val = [], []
+    for idx, val in pieces:
+        if idx is None:
+            dst.add_(val.to(dst.dtype))
+        else:
+            sparse_idx.append(idx.to(torch.int64))
+            sparse_val.append(val.to(dst.dtype))
+    if len(sparse_idx) > 0:
+        dst.index_add_(0, torch.cat(sparse_idx), torch.cat(sparse_val))
+    return dst
+
+
+def prefixed_segments(buf, lengths, head=1, tail=0):
+    r"""layout of the concatenated [n, head - 1 words, n items, tail words]
+    messages of all ranks, as sent by the variants that prefix their own
+    length. lengths holds every rank's n, allgathered next to the messages,
+    so the offsets are one prefix sum and nothing comes to the host, returns
+        pos:    positions of all items in buf
+        rank:   the sending rank of every item
+        starts: position of the first item of every rank"""
+    device = buf.device
+    lengths = lengths.to(device=device, dtype=torch.int64).view(-1)
+    world = lengths.numel()
+    sizes = lengths + head + tail
+    starts = sizes.cumsum(0) - sizes + head
+    total = buf.numel() - world * (head + tail)
+    rank = torch.repeat_interleave(torch.arange(world, device=device), lengths,
+                                   output_size=total)
+    first = lengths.cumsum(0) - lengths
+    pos = starts[rank] + torch.arange(total, device=device) - first[rank]
+    return pos, rank, starts
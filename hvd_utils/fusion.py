@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import threading
+
+import torch
+from horovod.torch.mpi_ops import allgather, _allgather_async, poll, synchronize
+
+
+class SparseFusion(object):
+    r"""tensor fusion for encoded sparse messages.
+    layers are cut into fixed buckets of about fusion_words int32 words, in the
+    order their gradients become ready. once every layer of a bucket has added
+    its message the bucket is sent with one allgather of the concatenated
+    messages. the buckets do not depend on timing or on the message sizes of a
+    step, so all ranks issue the same collectives. the words of every layer
+    and rank are gathered once per step in one small allgather, the offsets of
+    all messages are then a prefix sum over them. with a CommScheduler a
+    bucket goes out with the highest priority of its layers."""
+    def __init__(self, keys, sizes, fusion_words=262144, prefix='sparse_fusion',
+                 scheduler=None, priority=None):
+        self._keys = list(keys)
+        self._layer_id = {key: i for i, key in enumerate(self._keys)}
+        self._buckets = []
+        bucket, bucket_words = [], 0
+        for key, words in zip(self._keys, sizes):
+            if bucket and bucket_words + words > fusion_words:
+                self._buckets.append(bucket)
+                bucket, bucket_words = [], 0
+            bucket.append(key)
+            bucket_words += words
+        if bucket:
+            self._buckets.append(bucket)
+        self._bucket_of = {key: b for b, bucket in enumerate(self._buckets) for key in bucket}
+        self._prefix = prefix
+        self._scheduler = scheduler
+        self._priority = [0] * len(self._buckets)
+        if priority is not None:
+            self._priority = [min(priority[key] for key in bucket) for bucket in self._buckets]
+        self._pending = [{} for _ in self._buckets]
+        self._words = torch.zeros(len(self._keys), dtype=torch.int64)
+        self._starts = None
+        self._handles = {}
+        self._outputs = {}
+        self._added = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._bucket_of
+
+    @property
+    def num_buckets(self):
+        return len(self._buckets)
+
+    def pending_keys(self):
+        r"""the keys added since their messages were last handed out"""
+        return list(self._added)
+
+    def add(self, key, msg):
+        b = self._bucket_of[key]
+        with self._lock:
+            self._added.add(key)
+            self._words[self._layer_id[key]] = msg.numel()
+            self._pending[b][key] = msg
+            if len(self._pending[b]) == len(self._buckets[b]):
+                self._send(b)
+
+    def _send(self, b):
+        pending = self._pending[b]
+        if len(pending) == 0:
+            return
+        # layers that did not add a message count 0 words
+        fused = torch.cat([pending[key] for key in self._buckets[b] if key in pending])
+        output = fused.new_zeros(0)
+        name = '%s.%d' % (self._prefix, b)
+        if self._scheduler is None:
+            handle = _allgather_async(fused, output, name=name)
+        else:
+            handle = self._scheduler.submit(self._priority[b], fused.numel() * 4,
+                    lambda: _allgather_async(fused, output, name=name))
+        self._handles[b] = (handle, output)
+        self._pending[b] = {}
+
+    def flush(self):
+        r"""send the buckets that are still waiting for some of their layers"""
+        with self._lock:
+            for b in range(len(self._buckets)):
+                self._send(b)
+
+    def _exchange_words(self):
+        if self._starts is not None:
+            return
+        self.flush()
+        if self._scheduler is not None:
+            # nothing may be held back while this rank blocks on the words
+            self._scheduler.flush()
+        words = allgather(self._words.view(1, -1), name='%s.words' % self._prefix)
+        starts = torch.zeros_like(words)
+        lo = 0
+        for bucket in self._buckets:
+            hi = lo + len(bucket)
+            w = words[:, lo:hi]
+            # ranks one after the other, inside a rank the layers of the bucket
+            total = w.sum(1)
+            starts[:, lo:hi] = (total.cumsum(0) - total).unsqueeze(1) + w.cumsum(1) - w
+            lo = hi
+        self._starts = starts.t().tolist()
+
+    def poll(self, key):
+        r"""whether wait(key) would not block, before the words of the step
+        are in it would"""
+        b = self._bucket_of[key]
+        if self._starts is None:
+            return False
+        if b not in self._handles:
+            return True
+        handle = self._handles[b][0]
+        if self._scheduler is None:
+            return poll(handle)
+        return self._scheduler.poll(handle)
+
+    def _collect(self, b):
+        handle, output = self._handles.pop(b)
+        if self._scheduler is None:
+            synchronize(handle)
+        else:
+            self._scheduler.wait(handle)
+        self._outputs[b] = output
+
+    def wait(self, key):
+        r"""wait for the bucket of key only, returns (gathered buffer, per rank
+        start offsets of the message of key in it)"""
+        b = self._bucket_of[key]
+        self._exchange_words()
+        if b in self._handles:
+            self._collect(b)
+        output = self._outputs[b]
+        starts = self._starts[self._layer_id[key]]
+        self._added.discard(key)
+        if len(self._added) == 0:
+            self._words.zero_()
+            self._starts = None
+            self._outputs = {}
+        return output, starts
+
+    def synchronize(self):
+        r"""wait for all buckets, returns key -> (gathered buffer, per rank
+        start offsets)"""
+        keys = sorted(self._added, key=lambda key: (self._priority[self._bucket_of[key]],
+                                                    self._layer_id[key]))
+        return {key: self.wait(key) for key in keys}
@@ -0,0 +1,49 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+
+
+def _momentum_step_(grad, param, momentum_buf, residue_buf, momentum, weight_decay, world_size, nesterov):
+    grad.div_(world_size)
+    if weight_decay != 0:
+        grad.add_(param, alpha=weight_decay)
+    if nesterov:
+        momentum_buf.add_(grad).mul_(momentum)
+    else:
+        momentum_buf.mul_(momentum).add_(grad)
+    if residue_buf is None:
+        if nesterov:
+            grad.add_(momentum_buf)
+        else:
+            grad.copy_(momentum_buf)
+    else:
+        residue_buf.add_(momentum_buf)
+        if nesterov:
+            residue_buf.add_(grad)
+
+
+_compiled_step = None
+
+def _fused_step():
+    global _compiled_step
+    if _compiled_step is None:
+        if hasattr(torch, 'compile'):
+            _compiled_step = torch.compile(_momentum_step_, dynamic=True)
+        else:
+            _compiled_step = _momentum_step_
+    return _compiled_step
+
+
+def dgc_momentum_(grad, param, momentum_buf, residue_buf=None, momentum=0.9, weight_decay=1e-4,
+                  world_size=1, nesterov=True, fused=False):
+    r"""in place local DGC update, no model sized temporaries are allocated.
+    grad is averaged over world_size and weight decay is added, then
+        nesterov:     u = m * (u + g),  v += u + g
+        otherwise:    u = m * u + g,    v += u
+    without residue_buf the momentum corrected gradient (u + g, or u) is left in grad.
+    fused=True runs the whole step as one torch.compile kernel when available"""
+    step = _fused_step() if fused else _momentum_step_
+    step(grad, param, momentum_buf, residue_buf, momentum, weight_decay, world_size, nesterov)
+    return grad
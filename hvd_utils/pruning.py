@@ -18,10 +18,7 @@ def struct_pruning(x, perc, offset):
     else:
         idx = range(offset, offset + slice_size)
 
-    if torch.cuda.is_available():
-        mask = torch.zeros(x_len).cuda()
-    else:
-        mask = torch.zeros(x_len)
+    mask = torch.zeros(x_len, device=x.device)
     mask[idx] = 1.0
     mask = mask.view(x_size)
     return mask
@@ -53,42 +50,42 @@ def prune_relative_perc(x, y, perc):
     # x_top_idx = torch.LongTensor([i for i in range(x_len)]).cuda()
     #print(x_top_val, x_top_idx)
 
-    if torch.cuda.is_available():
-        mask = torch.zeros(x_len).cuda()
-    else:
-        mask = torch.zeros(x_len)
+    mask = torch.zeros(x_len, device=x.device)
 
     mask[x_top_idx] = 1.0
     mask = mask.view(x_size)
     return mask
 
+def select_bin_topk(x, bin_size=1024, topk=1):
+    r"""top k abs largest elements of every bin_size block of x, one batched topk for all
+    full blocks. the selected count only depends on numel(x), so every rank sends the
+    same message length. indices are grouped block by block, idx % bin_size is the
+    offset inside the block"""
+    x_flatten = x.view(-1)
+    x_len = x_flatten.numel()
+    x_abs = torch.abs(x_flatten)
+    nblocks = x_len // bin_size
+    full_len = nblocks * bin_size
+    x_idx = []
+    if nblocks > 0:
+        _, local_idx = torch.topk(x_abs[:full_len].view(nblocks, bin_size), min(topk, bin_size),
+                                  1, largest=True, sorted=False)
+        base = torch.arange(0, full_len, bin_size, dtype=torch.long, device=x.device).view(-1, 1)
+        x_idx.append((local_idx + base).view(-1))
+    if x_len > full_len:
+        _, local_idx = torch.topk(x_abs[full_len:], min(topk, x_len - full_len),
+                                  0, largest=True, sorted=False)
+        x_idx.append(local_idx + full_len)
+    x_idx = torch.cat(x_idx)
+    x_val = torch.index_select(x_flatten, 0, x_idx)
+    return x_val, x_idx
+
 def prune_bin(x, bin_size=1024, topk=1):
     r"""select upper(x/bin_size) elem from x"""
-    x_size = x.size()
-    x_len = 1;
-    for dim in x.size():
-        x_len *= dim
-
-    if torch.cuda.is_available():
-        mask = torch.zeros(x_len).cuda()
-    else:
-        mask = torch.zeros(x_len)
-
-    x_flatten = torch.abs(x.view(x_len))
-    offset = 0
-    x_top_idx = []
-    while offset < x_len:
-        if offset + bin_size < x_len:
-            _, idx = torch.topk(x_flatten[offset: offset + bin_size], topk, 0, largest=True, sorted=False)
-            mask[idx + offset] = 1.0
-        else:
-            _, idx = torch.topk(x_flatten[offset:], min(topk, x_len - offset), 0, largest=True, sorted=False)
-            mask[idx + offset] = 1.0
-
-        offset += bin_size
-
-    mask = mask.view(x_size)
-    return mask
+    _, x_idx = select_bin_topk(x, bin_size, topk)
+    mask = torch.zeros_like(x).view(-1)
+    mask[x_idx] = 1.0
+    return mask.view(x.size())
 
 def select_top_k_v2(x, pruning_ratio, U, V):
     r"""a fast function to select top k% abs largest elements, and assign indices to mask"""
@@ -286,6 +283,49 @@ def select_bs_top(x, pruning_ratio, l = 0.0, r = 1.0, param = 20.0):
     return rough_val, rough_indices, it, mid, N/x_len
 
 
+def _anchor_rank(top_k, tolerance):
+    # the middle of the band [top_k, (1+tolerance)*top_k] select_cached_thd accepts
+    return int(top_k * (1.0 + tolerance / 2)) + 1
+
+
+def cached_thd_anchor(x, pruning_ratio, tolerance=0.5):
+    r"""the threshold for select_cached_thd after a full selection: the magnitude
+    at rank (1+tolerance/2)*top_k, so that a residual that changes little keeps
+    the next candidate count inside the band. the k-th magnitude itself, or a
+    fixed fraction of it, lands at the edge or outside of it"""
+    x_flatten = x.view(-1)
+    top_k = int(x_flatten.numel() * pruning_ratio) + 1
+    rank = min(x_flatten.numel(), _anchor_rank(top_k, tolerance))
+    val, _ = torch.topk(torch.abs(x_flatten), rank, 0, largest=True, sorted=False)
+    return torch.min(val)
+
+
+def select_cached_thd(x, pruning_ratio, threshold, tolerance=0.5):
+    r"""reuse the threshold of a previous step, one comparison pass and a small topk
+    trim to exactly top k. returns None values when the candidate count leaves
+    [top_k, (1+tolerance)*top_k], the caller should then rerun a full selection.
+    the last value is the threshold for the next step, the candidate magnitude
+    at rank (1+tolerance/2)*top_k or threshold when fewer candidates passed"""
+    x_flatten = x.view(-1)
+    x_len = x_flatten.numel()
+    top_k = int(x_len * pruning_ratio) + 1
+    x_abs = torch.abs(x_flatten)
+
+    rough_indices = torch.nonzero(x_abs >= threshold).view(-1)
+    N = len(rough_indices)
+    if N < top_k or N > top_k * (1.0 + tolerance):
+        return None, None, N/x_len, None
+
+    rough_val = torch.index_select(x_abs, 0, rough_indices)
+    _, fine_indices = torch.topk(rough_val, top_k, 0, largest=True, sorted=False)
+    x_idx = torch.index_select(rough_indices, 0, fine_indices)
+    x_val = torch.index_select(x_flatten, 0, x_idx)
+    rank = _anchor_rank(top_k, tolerance)
+    if N >= rank:
+        threshold, _ = torch.kthvalue(rough_val, N - rank + 1)
+    return x_val, x_idx, N/x_len, threshold
+
+
 def select_top_k_thdv3(x, pruning_ratio, l = 0.0, r = 1.0, param = 20.0):
     r"""a fast function to select top k% abs largest elements with binary search on param, 
     and assign indices to mask"""
@@ -330,6 +370,42 @@ def select_top_k_thdv3(x, pruning_ratio, l = 0.0, r = 1.0, param = 20.0):
 
 
 
+def select_radix_topk(x, pruning_ratio, radix_bits=8):
+    r"""exact top k abs largest elements by radix select over the bit patterns of |x|.
+    non-negative floats are ordered like their int32 bit patterns, so the k-th
+    magnitude is fixed radix_bits at a time with one histogram pass per digit:
+    always 32/radix_bits passes, whatever the distribution of x"""
+    if 32 % radix_bits != 0:
+        raise ValueError('radix_bits should divide 32, got %d' % radix_bits)
+    x_flatten = x.view(-1)
+    x_len = x_flatten.numel()
+    top_k = int(x_len * pruning_ratio) + 1
+    x_bits = torch.abs(x_flatten).float().view(torch.int32)
+    nbins = 1 << radix_bits
+
+    prefix = 0
+    remain = top_k
+    for shift in range(32 - radix_bits, -1, -radix_bits):
+        digit = (x_bits >> shift) & (nbins - 1)
+        if shift + radix_bits < 32:
+            # elements outside the current prefix are counted in an extra bin
+            digit.masked_fill_((x_bits >> (shift + radix_bits)) != prefix, nbins)
+        counts = torch.bincount(digit, minlength=nbins + 1)[:nbins].tolist()
+        del digit
+        for d in range(nbins - 1, -1, -1):
+            if counts[d] >= remain:
+                break
+            remain -= counts[d]
+        prefix = (prefix << radix_bits) | d
+
+    # prefix is now the bit pattern of the k-th magnitude, remain of its ties are needed
+    gt_indices = torch.nonzero(x_bits > prefix).view(-1)
+    eq_indices = torch.nonzero(x_bits == prefix).view(-1)[:remain]
+    x_idx = torch.cat([gt_indices, eq_indices])
+    x_val = torch.index_select(x_flatten, 0, x_idx)
+    return x_val, x_idx
+
+
 def select_top_k_thdv2(x, pruning_ratio, param = 0.0):
     r"""a fast function to select top k% abs largest elements, and assign indices to mask"""
     x_size = x.size()
@@ -489,7 +565,7 @@ def select_lowk_truncated_mean(x, pruning_ratio, mask):
     return mask, x_val, x_idx
 
 
-def trunck_topk_param(x, r, pruning_ratio, mask):
+def trunck_topk_param(x, r, pruning_ratio):
     r"""a fast function to select top k% abs largest elements, and assign indices to mask"""
     r"""x is weight, x is residual"""
     x_size = x.size()
@@ -520,13 +596,7 @@ def trunck_topk_param(x, r, pruning_ratio, mask):
 
     r_flatten = r.view(-1)
     r_val = torch.index_select(r_flatten, 0, x_idx)
-
-    mask = mask.view(-1)
-    mask.zero_()
-    mask[x_idx] = 1.0
-    mask = 1.0 - mask
-    mask = mask.view(x_size)
-    return mask, r_val, x_idx
+    return r_val, x_idx
 
 
 def select_top_k_truncked(x, pruning_ratio, mask):
@@ -578,6 +648,22 @@ def select_topk(x, pruning_ratio):
 
     return x_val, x_idx
 
+def select_topk_batched(xs, pruning_ratio):
+    r"""top k abs largest elements of a list of tensors, tensors of the same size are
+    stacked and selected by one batched topk. returns a list of (val, idx)"""
+    selected = [None] * len(xs)
+    groups = {}
+    for i, x in enumerate(xs):
+        groups.setdefault(x.numel(), []).append(i)
+    for x_len, members in groups.items():
+        top_k = int(x_len * pruning_ratio) + 1
+        x_stack = torch.stack([xs[i].view(-1) for i in members])
+        _, x_idx = torch.topk(torch.abs(x_stack), top_k, 1, largest=True, sorted=False)
+        x_val = torch.gather(x_stack, 1, x_idx)
+        for row, i in enumerate(members):
+            selected[i] = (x_val[row], x_idx[row])
+    return selected
+
 def select_topk_mean(x, pruning_ratio):
     r"""a fast function to select top k% abs largest elements, and assign indices to mask"""
     x_size = x.size()
@@ -735,6 +821,20 @@ def select_top_k(x, pruning_ratio, mask):
     mask = mask.view(x_size)
     return mask, x_top_val, x_top_idx
 
+def clear_selected_(x, idx):
+    r"""zero the selected elements of x in place, replaces x.mul_(1 - mask)"""
+    x.view(-1).index_fill_(0, idx, 0.0)
+    return x
+
+def densify_selected(x, idx, val=None):
+    r"""a dense tensor like x holding val (by default x itself) at idx and zeros elsewhere"""
+    x_flatten = x.view(-1)
+    if val is None:
+        val = torch.index_select(x_flatten, 0, idx)
+    dense = torch.zeros_like(x_flatten)
+    dense[idx] = val
+    return dense.view(x.size())
+
 def prune_perc(x, perc):
     r"""this is an old API"""
     x_size = x.size()
@@ -746,10 +846,7 @@ def prune_perc(x, perc):
     top_k = int(x_len * perc) + 1
 
     _, x_top_idx = torch.topk(x_flatten, top_k, 0, largest=True, sorted=False)
-    if torch.cuda.is_available():
-        mask = torch.zeros(x_len).cuda()
-    else:
-        mask = torch.zeros(x_len)
+    mask = torch.zeros(x_len, device=x.device)
 
     mask[x_top_idx] = 1.0
     mask = mask.view(x_size)
@@ -767,19 +864,27 @@ def check_sparsity(x):
 #print(grad)
 #residue = x - grad
 #print(grad, residue)
-def kth(arr, topk, sample_rate=1):
-    # to numpy array
-    arr = arr.cpu().numpy().ravel()
+def _strided_sample(x_flatten, sample_rate, min_sample=16384):
+    r"""a strided subsample with a random start, taken on the device of x"""
+    x_len = x_flatten.numel()
+    stride = max(1, min(int(1.0 / sample_rate), x_len // min_sample))
+    if stride == 1:
+        return x_flatten
+    return x_flatten[np.random.randint(stride)::stride]
 
+def kth(arr, topk, sample_rate=1):
+    r"""k-th largest magnitude of arr, estimated on a subsample when sample_rate < 1.
+    the threshold is returned as a 0-dim tensor on the device of arr"""
+    arr = arr.contiguous().view(-1)
     if sample_rate < 1:
-        arr = np.random.choice(arr, int(arr.size * sample_rate), replace=False)
+        arr = _strided_sample(arr, sample_rate)
 
-    arr = np.abs(arr)
-    num = arr.size
+    arr = torch.abs(arr)
+    num = arr.numel()
 
     k = int(max(1, topk * num))
-    ids = np.argpartition(arr, -k)[-k:]
-    thr = float(np.min(arr[ids]))
+    top_val, _ = torch.topk(arr, k, 0, largest=True, sorted=False)
+    thr = torch.min(top_val)
 
     return thr
 
@@ -787,14 +892,40 @@ def prune_perc_sample(x, perc):
     x_size = x.size()
     x_len = np.prod(x_size)
     thr = 0
-    thr = kth(x, perc, 1.0)
-    # if(x_len > 1e4):
-    #     thr = kth(x, perc, 0.01)
-    # else:
-    #     thr = kth(x, perc, 1.0)
+    if(x_len > 1e4):
+        thr = kth(x, perc, 0.01)
+    else:
+        thr = kth(x, perc, 1.0)
     mask = (x.abs() >= thr).type(x.type())
     return mask
 
+def select_sample_thd(x, pruning_ratio, sample_rate=0.01, slack=0.25):
+    r"""select exactly top k abs largest elements from a sampled threshold.
+    the threshold is the (1+slack)*k-th magnitude of a subsample, so with high
+    probability one exact pass keeps between k and roughly (1+2*slack)*k candidates,
+    which are trimmed to k by a small topk. if the estimate keeps fewer than k
+    candidates a full topk is used, so the selected count never misses k"""
+    x_flatten = x.view(-1)
+    x_len = x_flatten.numel()
+    top_k = int(x_len * pruning_ratio) + 1
+    x_abs = torch.abs(x_flatten)
+
+    sample = _strided_sample(x_abs, sample_rate)
+    sample_k = min(sample.numel(), int(sample.numel() * pruning_ratio * (1.0 + slack)) + 1)
+    sample_val, _ = torch.topk(sample, sample_k, 0, largest=True, sorted=False)
+    threshold = torch.min(sample_val)
+
+    rough_indices = torch.nonzero(x_abs >= threshold).view(-1)
+    if len(rough_indices) < top_k:
+        _, x_idx = torch.topk(x_abs, top_k, 0, largest=True, sorted=False)
+    else:
+        rough_val = torch.index_select(x_abs, 0, rough_indices)
+        _, fine_indices = torch.topk(rough_val, top_k, 0, largest=True, sorted=False)
+        x_idx = torch.index_select(rough_indices, 0, fine_indices)
+
+    x_val = torch.index_select(x_flatten, 0, x_idx)
+    return x_val, x_idx
+
 
 def test_decompress():
     s = 1024
@@ -0,0 +1,89 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import heapq
+import threading
+
+from horovod.torch.mpi_ops import poll, synchronize
+
+
+class _Task(object):
+    def __init__(self, nbytes, start):
+        self.nbytes = nbytes
+        self.start = start
+        self.handle = None
+        self.done = False
+        self.result = None
+
+
+class CommScheduler(object):
+    r"""priority ordering of horovod collectives in the style of P3 and
+    ByteScheduler. submitted collectives are queued by priority, lower first,
+    and only started while less than credit bytes are in flight, so a front
+    layer that becomes ready late still overtakes the queued traffic of the
+    back layers. callers split large tensors into credit sized pieces.
+    horovod matches collectives by name, so ranks may start them in different
+    orders; wait() starts everything still queued before it blocks, so no rank
+    waits on a collective another rank holds back. the credit limit holds while
+    submit(), progress() and poll() are called, in backward that is from the
+    gradient hooks, the first wait() or flush() lets the rest out at once."""
+    def __init__(self, credit=4194304):
+        if credit <= 0:
+            raise ValueError('credit should be positive, got %s' % credit)
+        self._credit = credit
+        self._queue = []
+        self._inflight = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def submit(self, priority, nbytes, start):
+        r"""queue the collective start() -> handle, returns a task for wait()"""
+        task = _Task(nbytes, start)
+        with self._lock:
+            heapq.heappush(self._queue, (priority, self._seq, task))
+            self._seq += 1
+            self._dispatch()
+        return task
+
+    def _start(self, task):
+        task.handle = task.start()
+        self._inflight.append(task)
+
+    def _dispatch(self):
+        # finished pieces give their credit back
+        self._inflight = [t for t in self._inflight if not poll(t.handle)]
+        busy = sum(t.nbytes for t in self._inflight)
+        while self._queue and (busy == 0 or busy + self._queue[0][2].nbytes <= self._credit):
+            _, _, task = heapq.heappop(self._queue)
+            self._start(task)
+            busy += task.nbytes
+
+    def progress(self):
+        r"""start queued collectives as finished ones give their credit back"""
+        with self._lock:
+            self._dispatch()
+
+    def flush(self):
+        r"""start everything that is still queued, in priority order"""
+        with self._lock:
+            while self._queue:
+                _, _, task = heapq.heappop(self._queue)
+                self._start(task)
+
+    def poll(self, task):
+        r"""whether wait(task) would not block, the credit of finished pieces
+        goes to the queued ones on the way"""
+        self.progress()
+        return task.done or (task.handle is not None and poll(task.handle))
+
+    def wait(self, task):
+        if not task.done:
+            self.flush()
+            task.result = synchronize(task.handle)
+            task.done = True
+        with self._lock:
+            if task in self._inflight:
+                self._inflight.remove(task)
+            self._dispatch()
+        return task.result
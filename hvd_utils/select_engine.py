@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+import numpy as np
+import torch
+
+from .pruning import select_topk, select_trim_topk, select_trim_topkv2, select_top_k_thdv3, select_sample_thd, \
+        select_radix_topk, select_bin_topk
+
+
+def _select_thdv3(x, pruning_ratio):
+    val, idx, _, _, _ = select_top_k_thdv3(x, pruning_ratio)
+    return val, idx
+
+def _select_bin(x, pruning_ratio, bin_size=1024):
+    return select_bin_topk(x, bin_size, max(1, int(round(bin_size * pruning_ratio))))
+
+# name -> (selector, exact); every selector takes (x, pruning_ratio) and
+# returns (values, indices). exact selectors return a count that only depends
+# on the tensor size (int(n*ratio)+1, or one per block for 'bin'), the others
+# return a data dependent count. 'bin' is not a default candidate since it keeps
+# the largest elements of every block rather than of the whole tensor.
+SELECTORS = {
+    'topk': (select_topk, True),
+    'trim_topk': (select_trim_topk, True),
+    'trim_topkv2': (select_trim_topkv2, True),
+    'thdv3': (_select_thdv3, False),
+    'sample_thd': (select_sample_thd, True),
+    'radix': (select_radix_topk, True),
+    'bin': (_select_bin, True),
+}
+
+# selectors that keep the largest elements of every block, not of the tensor
+BLOCKWISE = ['bin']
+
+DEFAULT_CANDIDATES = ['topk', 'trim_topk', 'trim_topkv2', 'thdv3', 'sample_thd', 'radix']
+
+
+def heavy_tailed(numel):
+    r"""a gaussian scale mixture, with the heavy tail of DGC residuals. the
+    threshold and trim selectors iterate and keep candidates by the shape of
+    the tail, so gaussian data would time them wrong"""
+    return torch.randn(numel) * torch.exp(torch.randn(numel))
+
+
+class SelectEngine(object):
+    r"""route every tensor size to the fastest top-k selector measured on this machine.
+    sample(numel) makes the benchmark data, chunks of a layer have their own
+    plan so that a chunk size does not decide for a layer of the same size"""
+    def __init__(self, pruning_ratio=0.001, candidates=None, use_gpu=True, warmup=2, repeat=5,
+                 sample=heavy_tailed):
+        if candidates is None:
+            candidates = DEFAULT_CANDIDATES
+        for name in candidates:
+            if name not in SELECTORS:
+                raise ValueError('unknown selector %s, should be one of %s'
+                                 % (name, sorted(SELECTORS.keys())))
+        self.candidates = list(candidates)
+        self.pruning_ratio = pruning_ratio
+        self._use_gpu = use_gpu
+        self._warmup = warmup
+        self._repeat = repeat
+        self._sample = sample
+        # numel -> selector name, for whole layers and for chunks of layers
+        self._plan = {}
+        self._chunk_plan = {}
+        self.timings = {}
+
+    def _sync(self):
+        if self._use_gpu:
+            torch.cuda.synchronize()
+
+    def _bench(self, name, x):
+        select, _ = SELECTORS[name]
+        for _ in range(self._warmup):
+            select(x, self.pruning_ratio)
+        self._sync()
+        begin_time = time.time()
+        for _ in range(self._repeat):
+            select(x, self.pruning_ratio)
+        self._sync()
+        return (time.time() - begin_time) / self._repeat
+
+    def tune(self, numels):
+        r"""benchmark all candidates once per distinct size, keep the fastest"""
+        for numel in sorted(set(int(n) for n in numels)):
+            if numel in self._plan:
+                continue
+            x = self._sample(numel)
+            if self._use_gpu:
+                x = x.cuda()
+            cost = [self._bench(name, x) for name in self.candidates]
+            self.timings[numel] = dict(zip(self.candidates, cost))
+            self._plan[numel] = self.candidates[int(np.argmin(cost))]
+            del x
+        return self._plan
+
+    def pin(self, numel, name, chunk=False):
+        r"""route a size to a fixed selector, tune() will not benchmark it.
+        chunk pins only apply to select(..., chunk=True)"""
+        if name not in SELECTORS:
+            raise ValueError('unknown selector %s, should be one of %s'
+                             % (name, sorted(SELECTORS.keys())))
+        if name not in self.candidates:
+            self.candidates.append(name)
+        if chunk:
+            self._chunk_plan[int(numel)] = name
+        else:
+            self._plan[int(numel)] = name
+
+    def export_plan(self, numels):
+        r"""encode the plan as candidate ids, so that it can be broadcast from one rank"""
+        return torch.tensor([self.candidates.index(self.selector_name(n))
+                             for n in sorted(set(int(n) for n in numels))], dtype=torch.long)
+
+    def import_plan(self, numels, plan):
+        for numel, choice in zip(sorted(set(int(n) for n in numels)), plan.tolist()):
+            self._plan[numel] = self.candidates[int(choice)]
+
+    def selector_name(self, numel, chunk=False):
+        # untuned sizes fall back to the first candidate, unpinned chunks to
+        # the plan of their size
+        if chunk and int(numel) in self._chunk_plan:
+            return self._chunk_plan[int(numel)]
+        return self._plan.get(int(numel), self.candidates[0])
+
+    def is_exact(self, numel, chunk=False):
+        return SELECTORS[self.selector_name(numel, chunk)][1]
+
+    def is_global(self, numel, chunk=False):
+        r"""whether the selector keeps the top k of the whole tensor"""
+        return self.selector_name(numel, chunk) not in BLOCKWISE
+
+    def select(self, x, pruning_ratio=None, chunk=False):
+        if pruning_ratio is None:
+            pruning_ratio = self.pruning_ratio
+        select, _ = SELECTORS[self.selector_name(x.numel(), chunk)]
+        return select(x, pruning_ratio)
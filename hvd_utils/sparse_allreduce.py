@@ -0,0 +1,229 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+import torch.distributed as dist
+
+# message tags of one exchange
+_TAG_HEADER = 0
+_TAG_IDX = 1
+_TAG_VAL = 2
+
+
+def _global_rank(group, rank):
+    if group is None:
+        return rank
+    return dist.get_global_rank(group, rank)
+
+
+def _densify(idx, val, numel):
+    dense = torch.zeros(numel, dtype=val.dtype, device=val.device)
+    dense[idx] = val
+    return dense
+
+
+def _coalesce(idx, val):
+    idx, inverse = torch.unique(idx, return_inverse=True)
+    out = torch.zeros(idx.numel(), dtype=val.dtype, device=val.device)
+    out.index_add_(0, inverse, val)
+    return idx, out
+
+
+def _send(peer, idx, val, group):
+    # header is [count, dense], idx is None for a dense vector
+    header = torch.tensor([val.numel(), int(idx is None)], dtype=torch.int64, device=val.device)
+    reqs = [dist.isend(header, peer, group=group, tag=_TAG_HEADER)]
+    if idx is not None:
+        reqs.append(dist.isend(idx, peer, group=group, tag=_TAG_IDX))
+    reqs.append(dist.isend(val, peer, group=group, tag=_TAG_VAL))
+    return reqs
+
+
+def _recv(peer, like, group):
+    header = torch.zeros(2, dtype=torch.int64, device=like.device)
+    dist.recv(header, peer, group=group, tag=_TAG_HEADER)
+    count, dense = header.tolist()
+    idx = None
+    if not dense:
+        idx = torch.zeros(count, dtype=torch.int64, device=like.device)
+        dist.recv(idx, peer, group=group, tag=_TAG_IDX)
+    val = torch.zeros(count, dtype=like.dtype, device=like.device)
+    dist.recv(val, peer, group=group, tag=_TAG_VAL)
+    return idx, val
+
+
+def _exchange(peer, idx, val, group):
+    reqs = _send(peer, idx, val, group)
+    peer_idx, peer_val = _recv(peer, val, group)
+    for req in reqs:
+        req.wait()
+    return peer_idx, peer_val
+
+
+def _merge(low, high, numel, dense_cutoff):
+    r"""sum two vectors, low is the one of the lower rank. every index shows
+    up at most twice and a + b == b + a, so both partners get the same bits"""
+    (low_idx, low_val), (high_idx, high_val) = low, high
+    if low_idx is None or high_idx is None:
+        if low_idx is not None:
+            low_val = _densify(low_idx, low_val, numel)
+        if high_idx is not None:
+            high_val = _densify(high_idx, high_val, numel)
+        return None, low_val + high_val
+    idx, val = _coalesce(torch.cat([low_idx, high_idx]), torch.cat([low_val, high_val]))
+    if idx.numel() > dense_cutoff * numel:
+        return None, _densify(idx, val, numel)
+    return idx, val
+
+
+def _global_topk(idx, val, numel, topk):
+    r"""keep the topk largest entries, returns them and the dropped ones"""
+    if idx is None:
+        idx = torch.arange(numel, device=val.device)
+    if val.numel() <= topk:
+        return idx, val, None
+    _, keep = torch.topk(val.abs(), topk, sorted=False)
+    keep, _ = keep.sort()
+    dropped = torch.ones(val.numel(), dtype=torch.bool, device=val.device)
+    dropped[keep] = False
+    return idx[keep], val[keep], (idx[dropped], val[dropped])
+
+
+def _truncate(idx, val, numel, topk, residual):
+    idx, val, dropped = _global_topk(idx, val, numel, topk)
+    if dropped is not None and residual is not None:
+        residual.index_add_(0, dropped[0], dropped[1].to(residual.dtype))
+    return idx, val
+
+
+def sparse_allreduce(idx, val, numel, dense_cutoff=0.25, group=None, topk=None, residual=None):
+    r"""sum the sparse vectors (idx, val) of length numel over the ranks of group
+    by recursive doubling: log2(p) pairwise exchanges, each merging and
+    coalescing the two index sets. once the merged density crosses
+    dense_cutoff the vector is carried on dense. ranks beyond the largest power
+    of two first hand their vector to a partner and get the result back.
+    indices are int64, the result is bit identical on all ranks and is
+    returned as (idx, val), or as (None, dense) once it became dense.
+    the tensors have to live where the backend can send them, on the cpu
+    for gloo.
+    with topk only the topk largest entries survive every merge (gTop-k), so a
+    message never exceeds topk entries. the entries a merge drops are added to
+    the flat residual of the first rank of the merged block, which keeps the
+    sum of all residuals error compensated"""
+    if dense_cutoff <= 0 or dense_cutoff > 1:
+        raise ValueError('dense_cutoff should be in (0, 1], got %s' % dense_cutoff)
+    rank = dist.get_rank(group)
+    size = dist.get_world_size(group)
+    idx = idx.to(torch.int64).contiguous()
+    val = val.contiguous()
+    # an input that is already dense enough starts dense
+    if idx.numel() > dense_cutoff * numel:
+        idx, val = None, _densify(idx, val, numel)
+    if size == 1:
+        return idx, val
+
+    pof2 = 1
+    while pof2 * 2 <= size:
+        pof2 *= 2
+    extra = size - pof2
+
+    # fold the extra ranks into the first ones
+    if rank >= pof2:
+        for req in _send(_global_rank(group, rank - pof2), idx, val, group):
+            req.wait()
+    elif rank < extra:
+        peer = _recv(_global_rank(group, rank + pof2), val, group)
+        idx, val = _merge((idx, val), peer, numel, dense_cutoff)
+        if topk is not None:
+            idx, val = _truncate(idx, val, numel, topk, residual)
+
+    if rank < pof2:
+        mask = 1
+        while mask < pof2:
+            peer_rank = rank ^ mask
+            peer = _exchange(_global_rank(group, peer_rank), idx, val, group)
+            if rank < peer_rank:
+                idx, val = _merge((idx, val), peer, numel, dense_cutoff)
+            else:
+                idx, val = _merge(peer, (idx, val), numel, dense_cutoff)
+            if topk is not None:
+                # all 2 * mask ranks of the block now hold the same vector and
+                # drop the same entries, only the first one of them keeps them
+                idx, val = _truncate(idx, val, numel, topk,
+                                     residual if rank & (2 * mask - 1) == 0 else None)
+            mask *= 2
+
+    # hand the result back to the extra ranks
+    if rank >= pof2:
+        idx, val = _recv(_global_rank(group, rank - pof2), val, group)
+    elif rank < extra:
+        for req in _send(_global_rank(group, rank + pof2), idx, val, group):
+            req.wait()
+    return idx, val
+
+
+def sparse_reduce_scatter_allgather(idx, val, numel, shard_topk=None, group=None, residual=None):
+    r"""sum the sparse vectors (idx, val) of length numel over the ranks of group.
+    rank r owns the r-th contiguous range of the index space: every rank sends
+    its entries to their owners, each owner coalesces what it got, optionally
+    keeps only its shard_topk largest entries, and the reduced shards are
+    allgathered. a rank sends about k and receives about k plus the result,
+    instead of p * k. returns (idx, val) sorted by index, identical on all ranks.
+    the entries an owner drops are added to its flat residual when given"""
+    rank = dist.get_rank(group)
+    size = dist.get_world_size(group)
+    idx = idx.to(torch.int64).contiguous()
+    val = val.contiguous()
+    if size == 1:
+        idx, val = _coalesce(idx, val)
+        if shard_topk is not None:
+            idx, val = _truncate(idx, val, numel, shard_topk, residual)
+        return idx, val
+
+    shard = (numel + size - 1) // size
+    owner = idx // shard
+    order = owner.argsort()
+    idx, val, owner = idx[order], val[order], owner[order]
+    counts = torch.bincount(owner, minlength=size).tolist()
+
+    # all to all of the entries, the own part stays local
+    reqs = []
+    parts = [None] * size
+    offset = 0
+    for peer in range(size):
+        part = (idx[offset: offset + counts[peer]], val[offset: offset + counts[peer]])
+        offset += counts[peer]
+        if peer == rank:
+            parts[peer] = part
+        else:
+            reqs += _send(_global_rank(group, peer), part[0], part[1], group)
+    for peer in range(size):
+        if peer != rank:
+            parts[peer] = _recv(_global_rank(group, peer), val, group)
+    for req in reqs:
+        req.wait()
+
+    # reduce the own shard, in rank order so that it does not depend on arrival
+    shard_idx, shard_val = _coalesce(torch.cat([p[0] for p in parts]),
+                                     torch.cat([p[1] for p in parts]))
+    if shard_topk is not None:
+        shard_idx, shard_val = _truncate(shard_idx, shard_val, numel, shard_topk, residual)
+
+    # allgather the reduced shards, padded to the longest one
+    count = torch.tensor([shard_val.numel()], dtype=torch.int64, device=val.device)
+    counts = [torch.zeros_like(count) for _ in range(size)]
+    dist.all_gather(counts, count, group=group)
+    counts = [int(c) for c in counts]
+    longest = max(counts)
+    pad_idx = torch.zeros(longest, dtype=torch.int64, device=val.device)
+    pad_val = torch.zeros(longest, dtype=val.dtype, device=val.device)
+    pad_idx[:shard_idx.numel()] = shard_idx
+    pad_val[:shard_val.numel()] = shard_val
+    all_idx = [torch.zeros_like(pad_idx) for _ in range(size)]
+    all_val = [torch.zeros_like(pad_val) for _ in range(size)]
+    dist.all_gather(all_idx, pad_idx, group=group)
+    dist.all_gather(all_val, pad_val, group=group)
+    idx = torch.cat([i[:c] for i, c in zip(all_idx, counts)])
+    val = torch.cat([v[:c] for v, c in zip(all_val, counts)])
+    return idx, val
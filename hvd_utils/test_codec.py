@@ -0,0 +1,134 @@
+import torch
+from codec import encode, decode, decode_add_, quantize, message_size, prefixed_segments, \
+        ENC_COO, ENC_BITMAP, ENC_DENSE, ENC_DELTA
+
+# python test_codec.py
+# round trips of the sparse message codec on the cpu, a world of several
+# ranks is the concatenation of their messages as an allgather returns it
+
+ENCODINGS = [('coo', ENC_COO), ('bitmap', ENC_BITMAP), ('dense', ENC_DENSE), ('delta', ENC_DELTA)]
+
+
+def sample(numel, count, seed):
+    torch.manual_seed(seed)
+    idx = torch.randperm(numel)[:count]
+    val = torch.randn(count)
+    return idx, val
+
+
+def to_dense(idx, val, numel):
+    dense = torch.zeros(numel)
+    if idx is None:
+        return dense + val.float()
+    dense.index_add_(0, idx.long(), val.float())
+    return dense
+
+
+def check_round_trip(numel, counts, encoding, dtype=torch.float32):
+    r"""every rank sends counts[rank] values of dtype with the given encoding"""
+    msgs, ref = [], torch.zeros(numel)
+    for rank, count in enumerate(counts):
+        idx, val = sample(numel, count, 123 + rank)
+        if dtype == torch.float16:
+            val = val.half()
+        elif dtype in ('int8', 'sign2'):
+            val = quantize(val, dtype, stochastic=False)
+        msg = encode(idx, val, numel, encoding)
+        assert msg.dtype == torch.int32, 'messages should be int32'
+        if encoding != ENC_DELTA:
+            assert msg.numel() == message_size(count, val.dtype, encoding, numel), \
+                    'wrong message size for count %d' % count
+        ref += to_dense(idx, val.values if dtype in ('int8', 'sign2') else val, numel)
+        msgs.append(msg)
+    msg = torch.cat(msgs)
+
+    pieces = decode(msg, numel=numel)
+    assert len(pieces) == len(counts), 'decoded %d ranks, sent %d' % (len(pieces), len(counts))
+    out = sum(to_dense(idx, val, numel) for idx, val in pieces)
+    assert torch.allclose(out, ref, atol=1e-6), 'decode differs from the reference'
+
+    out = decode_add_(torch.zeros(numel), msg)
+    assert torch.allclose(out, ref, atol=1e-6), 'decode_add_ differs from the reference'
+
+    # the same with the rank offsets given, as from Allgatherv
+    sizes = torch.tensor([m.numel() for m in msgs])
+    starts = (sizes.cumsum(0) - sizes).tolist()
+    out = decode_add_(torch.zeros(numel), msg, starts=starts)
+    assert torch.allclose(out, ref, atol=1e-6), 'decode_add_ with starts differs'
+
+
+def check_fixed_count(numel, count, world):
+    r"""the header free path, every rank sends count fp32 values"""
+    msgs, ref = [], torch.zeros(numel)
+    for rank in range(world):
+        idx, val = sample(numel, count, 321 + rank)
+        msgs.append(encode(idx, val, numel))
+        ref += to_dense(idx, val, numel)
+    msg = torch.cat(msgs)
+    out = decode_add_(torch.zeros(numel), msg, count=count)
+    assert torch.allclose(out, ref, atol=1e-6), 'fixed count decode differs'
+
+    # a fused buffer holds other messages in front and behind
+    pad = torch.full((5,), -1, dtype=torch.int32)
+    fused = torch.cat([pad] + [torch.cat([m, pad]) for m in msgs])
+    starts = [5 + rank * (msgs[0].numel() + 5) for rank in range(world)]
+    out = decode_add_(torch.zeros(numel), fused, count=count, starts=starts)
+    assert torch.allclose(out, ref, atol=1e-6), 'fixed count decode with starts differs'
+
+
+def check_quantize(numel, count, dtype):
+    r"""the decoded values are the quantized ones and within a step of the input"""
+    idx, val = sample(numel, count, 7)
+    q = quantize(val, dtype, stochastic=False)
+    [(out_idx, out_val)] = decode(encode(idx, q), numel=numel)
+    assert torch.equal(out_idx.long(), idx), 'indices changed'
+    assert torch.allclose(out_val, q.values), 'values differ from the quantized ones'
+    step = q.scale if dtype == 'int8' else val.abs().max()
+    assert float((out_val - val).abs().max()) <= float(step) * (1 + 1e-6), \
+            'quantization error above one step'
+
+
+def check_prefixed_segments(lengths, head, tail):
+    r"""[n, head - 1 words, n items, tail words] per rank, items numbered in order"""
+    buf, items, ranks, firsts = [], [], [], []
+    for rank, n in enumerate(lengths):
+        firsts.append(len(buf) + head)
+        buf += [n] + [-1] * (head - 1)
+        buf += list(range(len(items), len(items) + n))
+        items += list(range(len(items), len(items) + n))
+        ranks += [rank] * n
+        buf += [-2] * tail
+    buf = torch.tensor(buf)
+    pos, rank, starts = prefixed_segments(buf, torch.tensor(lengths), head, tail)
+    assert buf[pos].tolist() == items, 'wrong item positions'
+    assert rank.tolist() == ranks, 'wrong item ranks'
+    assert starts.tolist() == firsts, 'wrong rank starts'
+
+
+if __name__ == '__main__':
+    numel = 10007
+    for name, encoding in ENCODINGS:
+        for counts in ([0], [0, 0, 0], [1], [17, 5, 0, 33], [numel // 3, 9, numel // 2]):
+            check_round_trip(numel, counts, encoding)
+            check_round_trip(numel, counts, encoding, torch.float16)
+        for dtype in ('int8', 'sign2'):
+            check_round_trip(numel, [1, 17, 5, 33], encoding, dtype)
+        print('%s: ok' % name)
+
+    # fp16 packs two values per word, odd counts leave half a word of padding
+    check_round_trip(numel, [3, 1, 7], ENC_COO, torch.float16)
+    print('fp16 odd counts: ok')
+
+    for count, world in [(1, 1), (17, 4), (33, 3), (numel // 2, 2)]:
+        check_fixed_count(numel, count, world)
+    print('fixed count: ok')
+
+    for dtype in ('int8', 'sign2'):
+        for count in (1, 5, 33, 1000):
+            check_quantize(numel, count, dtype)
+    print('int8 and sign2 against the dense reference: ok')
+
+    for lengths in ([0], [3], [2, 0, 5], [0, 0], [1, 4, 1, 0, 7]):
+        for head, tail in [(1, 0), (2, 0), (1, 1)]:
+            check_prefixed_segments(lengths, head, tail)
+    print('prefixed segments: ok')
@@ -0,0 +1,137 @@
+import os
+import torch
+import torch.distributed as dist
+from sparse_allreduce import sparse_allreduce, sparse_reduce_scatter_allgather
+
+# mpirun -np 8 python test_sparse_allreduce.py
+# checks the sparse allreduce against a dense allreduce on the cpu with gloo
+
+def init_from_mpi():
+    for rank_var, size_var in (('OMPI_COMM_WORLD_RANK', 'OMPI_COMM_WORLD_SIZE'),
+                               ('PMI_RANK', 'PMI_SIZE')):
+        if rank_var in os.environ:
+            os.environ.setdefault('RANK', os.environ[rank_var])
+            os.environ.setdefault('WORLD_SIZE', os.environ[size_var])
+    os.environ.setdefault('RANK', '0')
+    os.environ.setdefault('WORLD_SIZE', '1')
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29511')
+    dist.init_process_group('gloo', init_method='env://')
+
+
+def to_dense(idx, val, numel):
+    if idx is None:
+        return val
+    dense = torch.zeros(numel)
+    dense[idx] = val
+    return dense
+
+
+def check(numel, density, dense_cutoff, group=None):
+    rank = dist.get_rank()
+    torch.manual_seed(123 + rank)
+    nnz = max(1, int(numel * density))
+    idx = torch.randperm(numel)[:nnz]
+    val = torch.randn(nnz)
+
+    ref = to_dense(idx, val, numel)
+    dist.all_reduce(ref, group=group)
+
+    out_idx, out_val = sparse_allreduce(idx, val, numel, dense_cutoff, group)
+    out = to_dense(out_idx, out_val, numel)
+    assert torch.allclose(out, ref, atol=1e-5), 'wrong sum on rank %d' % rank
+
+    # bit identical on all ranks
+    gathered = [torch.zeros(numel) for _ in range(dist.get_world_size(group))]
+    dist.all_gather(gathered, out, group=group)
+    for other in gathered:
+        assert torch.equal(other, gathered[0]), 'ranks disagree'
+    return out_idx is None
+
+
+def check_topk(numel, density, topk):
+    rank = dist.get_rank()
+    torch.manual_seed(321 + rank)
+    nnz = max(1, int(numel * density))
+    idx = torch.randperm(numel)[:nnz]
+    val = torch.randn(nnz)
+
+    ref = to_dense(idx, val, numel)
+    dist.all_reduce(ref)
+
+    residual = torch.zeros(numel)
+    out_idx, out_val = sparse_allreduce(idx, val, numel, topk=topk, residual=residual)
+    assert out_val.numel() <= topk, 'more than topk entries on rank %d' % rank
+
+    # what was kept plus what went back to the residuals is the full sum
+    total = to_dense(out_idx, out_val, numel)
+    dist.all_reduce(residual)
+    assert torch.allclose(total + residual, ref, atol=1e-5), 'mass lost on rank %d' % rank
+
+    gathered = [torch.zeros(numel) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, to_dense(out_idx, out_val, numel))
+    for other in gathered:
+        assert torch.equal(other, gathered[0]), 'ranks disagree'
+
+
+def check_reduce_scatter(numel, density, shard_topk=None):
+    rank = dist.get_rank()
+    size = dist.get_world_size()
+    torch.manual_seed(213 + rank)
+    nnz = max(1, int(numel * density))
+    idx = torch.randperm(numel)[:nnz]
+    val = torch.randn(nnz)
+
+    ref = to_dense(idx, val, numel)
+    dist.all_reduce(ref)
+
+    residual = torch.zeros(numel)
+    out_idx, out_val = sparse_reduce_scatter_allgather(idx, val, numel, shard_topk,
+                                                       residual=residual)
+    total = to_dense(out_idx, out_val, numel)
+    if shard_topk is None:
+        assert torch.allclose(total, ref, atol=1e-5), 'wrong sum on rank %d' % rank
+        assert torch.equal(residual, torch.zeros(numel)), 'residual without shard_topk'
+    else:
+        assert out_val.numel() <= size * shard_topk, 'more than shard_topk per shard'
+        # what the owners kept plus what went back to their residuals is the full sum
+        dist.all_reduce(residual)
+        assert torch.allclose(total + residual, ref, atol=1e-5), 'mass lost on rank %d' % rank
+
+    gathered = [torch.zeros(numel) for _ in range(size)]
+    dist.all_gather(gathered, total)
+    for other in gathered:
+        assert torch.equal(other, gathered[0]), 'ranks disagree'
+
+
+if __name__ == '__main__':
+    init_from_mpi()
+    rank = dist.get_rank()
+    size = dist.get_world_size()
+
+    for numel, density, dense_cutoff in [(100000, 0.001, 0.25), (100000, 0.01, 0.25),
+                                         (100000, 0.1, 0.25), (1000, 0.5, 0.25)]:
+        became_dense = check(numel, density, dense_cutoff)
+        if rank == 0:
+            print('numel %d density %g cutoff %g: ok, dense result %s'
+                  % (numel, density, dense_cutoff, became_dense))
+
+    check_topk(100000, 0.001, 100)
+    if rank == 0:
+        print('global top k: ok')
+
+    # a shard size that does not divide numel
+    for numel, density in [(100003, 0.001), (100003, 0.05), (1000, 0.5)]:
+        check_reduce_scatter(numel, density)
+    check_reduce_scatter(100003, 0.01, shard_topk=50)
+    if rank == 0:
+        print('reduce scatter allgather: ok, with shard top k: ok')
+
+    # a group of the even ranks
+    even = dist.new_group(list(range(0, size, 2)))
+    if rank % 2 == 0:
+        check(100000, 0.001, 0.25, even)
+        if rank == 0:
+            print('group of %d even ranks: ok' % len(range(0, size, 2)))
+
+    dist.barrier()
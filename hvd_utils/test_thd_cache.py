@@ -0,0 +1,48 @@
+import torch
+from pruning import select_topk, select_cached_thd, cached_thd_anchor, clear_selected_
+from momentum import dgc_momentum_
+
+# python test_thd_cache.py
+# counts how often the threshold of the last step is reused on DGC residuals,
+# the same momentum, residual accumulation and clearing as DGCoptimizer_hybrid
+
+RATIO = 0.001
+TOLERANCE = 0.5
+
+
+def run(numel, sample, steps, warmup):
+    torch.manual_seed(123)
+    param = torch.zeros(numel)
+    momentum = torch.zeros(numel)
+    residue = torch.zeros(numel)
+    thd = None
+    hits, misses = 0, 0
+    for step in range(warmup + steps):
+        grad = sample(numel)
+        dgc_momentum_(grad, param, momentum, residue, 0.9, 0.0, 1, False)
+        val = None
+        if thd is not None:
+            val, idx, _, thd = select_cached_thd(residue, RATIO, thd, TOLERANCE)
+        hit = val is not None
+        if not hit:
+            val, idx = select_topk(residue, RATIO)
+            thd = cached_thd_anchor(residue, RATIO, TOLERANCE)
+        assert val.numel() == int(numel * RATIO) + 1, 'a hit should send exactly top k'
+        ref, _ = select_topk(residue, RATIO)
+        assert torch.allclose(val.abs().sort()[0], ref.abs().sort()[0]), 'a hit is not top k'
+        clear_selected_(residue, idx)
+        clear_selected_(momentum, idx)
+        if step >= warmup:
+            hits += hit
+            misses += not hit
+    return hits, misses
+
+
+if __name__ == '__main__':
+    laplace = torch.distributions.Laplace(0.0, 1.0)
+    samples = [('gaussian', torch.randn), ('laplace', lambda n: laplace.sample((n,)))]
+    for name, sample in samples:
+        # the residual is stationary once every entry was sent about once, 1 / RATIO steps
+        hits, misses = run(200000, sample, 300, 1500)
+        print('%s residuals: %d hits, %d misses' % (name, hits, misses))
+        assert hits >= 4 * misses, 'the threshold cache misses on %s residuals' % name
@@ -237,6 +237,9 @@ def main():
         cudnn.benchmark = True
     else:
         args.gpus = None
+        # share the cores of a cpu node among the local ranks, so that the
+        # MKL/OpenMP kernels of the compression pipeline do not oversubscribe
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // hvd.local_size()))
 
     # create model
     if hvd.rank()== 0:
@@ -508,7 +511,8 @@ def forward(data_loader, model, criterion, epoch=0, training=True, optimizer=Non
             #if args.use_pruning:
             #    clip_grad_norm(model.parameters(), 5. * (hvd.size() ** -0.5))
             if args.use_pruning:
-                torch.cuda.synchronize()
+                if args.gpus is not None:
+                    torch.cuda.synchronize()
                 optimizer.pruning_time = 0.0
                 optimizer.select_time = 0.0
                 optimizer.pack_time = 0.0
@@ -523,7 +527,8 @@ def forward(data_loader, model, criterion, epoch=0, training=True, optimizer=Non
 
             # Master
             if args.use_pruning:
-                torch.cuda.synchronize()
+                if args.gpus is not None:
+                    torch.cuda.synchronize()
                 pruning_time.update(optimizer.pruning_time)
                 select_time.update(optimizer.select_time)
                 pack_time.update(optimizer.pack_time)